@@ -0,0 +1,164 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Adaptive choice of target bitrates, based on the quality reached by previous
+# encodes of the same clip and encoder. Quality is assumed to increase with
+# bitrate and curves are interpolated in log-bitrate.
+
+import math
+
+# Bitrates are multiples of this, so that temporal layer splits (45%, 60% and
+# 65% of the target bitrate) are whole kbps and graphs group them correctly.
+BITRATE_STEP_KBPS = 20
+
+
+def round_kbps(kbps):
+  return max(BITRATE_STEP_KBPS, int(round(float(kbps) / BITRATE_STEP_KBPS)) * BITRATE_STEP_KBPS)
+
+
+def log_midpoint(low_kbps, high_kbps):
+  return round_kbps(math.sqrt(low_kbps * high_kbps))
+
+
+def quadratic_at(x, (x0, y0), (x1, y1), (x2, y2)):
+  # Lagrange interpolation through three points.
+  return (y0 * (x - x1) * (x - x2) / ((x0 - x1) * (x0 - x2)) +
+          y1 * (x - x0) * (x - x2) / ((x1 - x0) * (x1 - x2)) +
+          y2 * (x - x0) * (x - x1) / ((x2 - x0) * (x2 - x1)))
+
+
+class BitrateSearch(object):
+  """Chooses bitrates to encode one clip with one encoder at.
+
+  With |targets|, bitrates reaching each target quality (within |tolerance|)
+  are searched for by interpolating between the closest points below and
+  above the target. Otherwise the curve is refined where linear interpolation
+  between neighbouring points is estimated to be off by more than |tolerance|.
+  No more than |max_encodes| bitrates are handed out in total.
+
+  Bitrates are handed out in rounds, the next round is chosen once results of
+  all bitrates of the previous one have been added.
+  """
+
+  def __init__(self, initial_kbps, min_kbps, max_kbps, targets, tolerance, max_encodes):
+    self.min_kbps = round_kbps(min_kbps)
+    self.max_kbps = round_kbps(max_kbps)
+    self.targets = targets
+    self.tolerance = tolerance
+    self.remaining_encodes = max_encodes
+    # Quality reached at each bitrate, None for failed encodes.
+    self.points = {}
+    self.in_flight = set()
+    self.initial_kbps = [round_kbps(kbps) for kbps in initial_kbps]
+
+  def start(self):
+    """Returns the bitrates of the first round."""
+    return self.issue(self.initial_kbps)
+
+  def add_result(self, kbps, quality):
+    """Records the quality at |kbps|, returns bitrates to encode next."""
+    self.in_flight.discard(kbps)
+    self.points[kbps] = quality
+    if self.in_flight:
+      return []
+    return self.issue(self.target_bitrates() if self.targets else self.refinement_bitrates())
+
+  def is_done(self):
+    return not self.in_flight
+
+  def issue(self, bitrates):
+    issued = []
+    for kbps in bitrates:
+      kbps = min(max(round_kbps(kbps), self.min_kbps), self.max_kbps)
+      if kbps in self.points or kbps in self.in_flight or kbps in issued:
+        continue
+      if len(issued) >= self.remaining_encodes:
+        break
+      issued.append(kbps)
+    self.remaining_encodes -= len(issued)
+    self.in_flight.update(issued)
+    return issued
+
+  def sampled(self):
+    return sorted((kbps, quality) for (kbps, quality) in self.points.iteritems() if quality is not None)
+
+  def bracket(self, target):
+    """Returns adjacent points with qualities on both sides of |target|."""
+    points = self.sampled()
+    for (low, high) in zip(points, points[1:]):
+      if low[1] < target <= high[1]:
+        return (low, high)
+    return None
+
+  def interpolate(self, target):
+    """Estimates the bitrate reaching |target|, or None if not bracketed."""
+    bracket = self.bracket(target)
+    if not bracket:
+      return None
+    ((low_kbps, low_quality), (high_kbps, high_quality)) = bracket
+    fraction = (target - low_quality) / (high_quality - low_quality)
+    return math.exp(math.log(low_kbps) + fraction * (math.log(high_kbps) - math.log(low_kbps)))
+
+  def target_bitrates(self):
+    points = self.sampled()
+    if not points:
+      return []
+    bitrates = []
+    for target in self.targets:
+      if any(abs(quality - target) <= self.tolerance for (_, quality) in points):
+        continue
+      if target > max(quality for (_, quality) in points):
+        bitrates.append(points[-1][0] * 2)
+      elif target <= min(quality for (_, quality) in points):
+        bitrates.append(points[0][0] / 2)
+      elif self.bracket(target):
+        ((low_kbps, _), (high_kbps, _)) = self.bracket(target)
+        kbps = round_kbps(self.interpolate(target))
+        # Always move inside the bracket so that the search makes progress.
+        kbps = min(max(kbps, low_kbps + BITRATE_STEP_KBPS), high_kbps - BITRATE_STEP_KBPS)
+        if kbps > low_kbps:
+          bitrates.append(kbps)
+    return bitrates
+
+  def refinement_bitrates(self):
+    points = [(math.log(kbps), quality) for (kbps, quality) in self.sampled()]
+    candidates = []
+    for i in range(len(points) - 1):
+      (low_kbps, high_kbps) = (round_kbps(math.exp(points[i][0])), round_kbps(math.exp(points[i + 1][0])))
+      midpoint_kbps = log_midpoint(low_kbps, high_kbps)
+      if midpoint_kbps in [low_kbps, high_kbps]:
+        continue
+      # Compare linear interpolation at the midpoint to quadratics that also
+      # pass through a neighbouring point.
+      x = math.log(midpoint_kbps)
+      linear = points[i][1] + (points[i + 1][1] - points[i][1]) * (x - points[i][0]) / (points[i + 1][0] - points[i][0])
+      estimates = [abs(quadratic_at(x, points[i], points[i + 1], points[j]) - linear) for j in [i - 1, i + 2] if 0 <= j < len(points)]
+      error = max(estimates) if estimates else float('inf')
+      if error > self.tolerance:
+        candidates.append((error, midpoint_kbps))
+    return [kbps for (error, kbps) in sorted(candidates, reverse=True)]
+
+  def summary(self):
+    """Describes bitrates found for each target."""
+    lines = []
+    for target in self.targets:
+      kbps = self.interpolate(target)
+      closest = min(self.sampled(), key=lambda (kbps, quality): abs(quality - target)) if self.sampled() else None
+      if kbps is not None:
+        lines.append("%g at ~%d kbps (closest encode: %g at %d kbps)" % (target, kbps, closest[1], closest[0]))
+      elif closest:
+        lines.append("%g not reached (closest encode: %g at %d kbps)" % (target, closest[1], closest[0]))
+      else:
+        lines.append("%g not reached (no successful encodes)" % target)
+    return lines
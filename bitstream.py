@@ -0,0 +1,303 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Minimal parsing of encoded files, enough to get the size, type and temporal
+# layer of every frame without decoding. Supports IVF and WebM (as written by
+# vpxenc and aomenc) with VP8, VP9 or AV1, and H.264 Annex B byte streams.
+
+import mmap
+import os
+import struct
+
+# Bump when frames parsed from the same file change.
+VERSION = 1
+
+IVF_MAGIC = 'DKIF'
+EBML_MAGIC = '\x1a\x45\xdf\xa3'
+
+IVF_FOURCCS = {'VP80': 'vp8', 'VP90': 'vp9', 'AV01': 'av1'}
+WEBM_CODEC_IDS = {'V_VP8': 'vp8', 'V_VP9': 'vp9', 'V_AV1': 'av1'}
+
+# EBML element IDs, including their length marker bits.
+EBML_SEGMENT = 0x18538067
+EBML_CLUSTER = 0x1f43b675
+EBML_TRACKS = 0x1654ae6b
+EBML_TRACK_ENTRY = 0xae
+EBML_CODEC_ID = 0x86
+EBML_BLOCK_GROUP = 0xa0
+EBML_BLOCK = 0xa1
+EBML_SIMPLE_BLOCK = 0xa3
+# Elements whose children are parsed, everything else is skipped.
+EBML_MASTER_ELEMENTS = [EBML_SEGMENT, EBML_CLUSTER, EBML_TRACKS, EBML_TRACK_ENTRY, EBML_BLOCK_GROUP]
+
+AV1_OBU_SEQUENCE_HEADER = 1
+
+H264_NAL_SLICE = 1
+H264_NAL_IDR_SLICE = 5
+H264_NAL_SEI = 6
+H264_NAL_SPS = 7
+H264_NAL_PPS = 8
+H264_NAL_AUD = 9
+H264_NAL_PREFIX = 14
+H264_NAL_SUBSET_SPS = 15
+H264_NAL_SLICE_EXTENSION = 20
+# NAL units that start a new access unit when they follow a picture's slices.
+H264_AU_START_NALS = [H264_NAL_SEI, H264_NAL_SPS, H264_NAL_PPS, H264_NAL_AUD, H264_NAL_PREFIX, H264_NAL_SUBSET_SPS]
+
+
+class BitstreamError(Exception):
+  pass
+
+
+def read_frames(filename):
+  """Yields (size in bytes, frame type, temporal layer) for each frame.
+
+  Frame types are 'key' or 'inter', or None if unknown. Temporal layers are
+  only known for streams that signal them (AV1 and SVC H.264), None
+  otherwise. The file is read once, sequentially.
+  """
+  with open(filename, 'rb') as f:
+    magic = f.read(4)
+    f.seek(0)
+    if magic == IVF_MAGIC:
+      frames = read_ivf_frames(f)
+    elif magic == EBML_MAGIC:
+      frames = read_webm_frames(f)
+    elif magic.startswith('\x00\x00\x01') or magic == '\x00\x00\x00\x01':
+      frames = read_annexb_frames(f)
+    else:
+      raise BitstreamError("Unknown format of '%s'." % filename)
+    for frame in frames:
+      yield frame
+
+
+def frame_info(codec, data):
+  """Returns (frame type, temporal layer) of a VP8, VP9 or AV1 frame."""
+  if not data:
+    return (None, None)
+  if codec == 'vp8':
+    # The first bit of the frame tag is 0 for key frames.
+    return ('key' if ord(data[0]) & 0x01 == 0 else 'inter', None)
+  if codec == 'vp9':
+    return (vp9_frame_type(data), None)
+  if codec == 'av1':
+    return av1_frame_info(data)
+  return (None, None)
+
+
+def vp9_frame_type(data):
+  first = ord(data[0])
+  if first >> 6 != 2:
+    # Not a frame marker.
+    return None
+  profile = ((first >> 5) & 1) | (((first >> 4) & 1) << 1)
+  # Profile 3 has a reserved zero bit after the profile bits.
+  bit = 3 if profile < 3 else 2
+  if (first >> bit) & 1:
+    # show_existing_frame, repeats an earlier frame.
+    return 'inter'
+  return 'key' if (first >> (bit - 1)) & 1 == 0 else 'inter'
+
+
+def leb128(data, position):
+  value = 0
+  for i in range(8):
+    if position + i >= len(data):
+      raise BitstreamError("Truncated OBU size.")
+    byte = ord(data[position + i])
+    value |= (byte & 0x7f) << (7 * i)
+    if not byte & 0x80:
+      return (value, position + i + 1)
+  raise BitstreamError("Invalid OBU size.")
+
+
+def av1_frame_info(data):
+  """Frame type and temporal layer of an AV1 temporal unit.
+
+  aomenc writes a sequence header at every key frame, which is used to tell
+  them apart instead of parsing frame headers.
+  """
+  (frame_type, temporal_layer) = ('inter', None)
+  position = 0
+  while position < len(data):
+    header = ord(data[position])
+    obu_type = (header >> 3) & 0x0f
+    position += 1
+    if header & 0x04:
+      if position >= len(data):
+        raise BitstreamError("Truncated OBU extension.")
+      # The extension byte carries temporal and spatial layer IDs.
+      temporal_layer = ord(data[position]) >> 5
+      position += 1
+    if not header & 0x02:
+      # The last OBU may leave out its size.
+      if obu_type == AV1_OBU_SEQUENCE_HEADER:
+        frame_type = 'key'
+      break
+    (size, position) = leb128(data, position)
+    if obu_type == AV1_OBU_SEQUENCE_HEADER:
+      frame_type = 'key'
+    position += size
+  return (frame_type, temporal_layer)
+
+
+def read_ivf_frames(f):
+  header = f.read(32)
+  if len(header) < 32:
+    raise BitstreamError("Truncated IVF header.")
+  (header_size, fourcc) = struct.unpack('<H4s', header[6:12])
+  codec = IVF_FOURCCS.get(fourcc)
+  f.seek(header_size)
+  while True:
+    frame_header = f.read(12)
+    if not frame_header:
+      return
+    if len(frame_header) < 12:
+      raise BitstreamError("Truncated IVF frame header.")
+    (size, _) = struct.unpack('<IQ', frame_header)
+    data = f.read(size)
+    if len(data) < size:
+      raise BitstreamError("Truncated IVF frame.")
+    (frame_type, temporal_layer) = frame_info(codec, data)
+    yield (size, frame_type, temporal_layer)
+
+
+def read_ebml_vint(f, keep_marker):
+  """Reads an EBML variable-length integer, returns (value, unknown size).
+
+  Returns None at the end of the file.
+  """
+  first = f.read(1)
+  if not first:
+    return None
+  value = ord(first)
+  length = 1
+  while length <= 8 and not value & (0x80 >> (length - 1)):
+    length += 1
+  if length > 8:
+    raise BitstreamError("Invalid EBML integer.")
+  if not keep_marker:
+    value &= (0x80 >> (length - 1)) - 1
+  rest = f.read(length - 1)
+  if len(rest) < length - 1:
+    raise BitstreamError("Truncated EBML integer.")
+  for c in rest:
+    value = (value << 8) | ord(c)
+  unknown = not keep_marker and value == (1 << (7 * length)) - 1
+  return (value, unknown)
+
+
+def read_webm_frames(f):
+  """Yields frames of the first track of a WebM file.
+
+  Master elements are parsed as a flat sequence of elements, which also
+  handles elements of unknown size as written to non-seekable outputs.
+  """
+  codec = None
+  track = None
+  while True:
+    element = read_ebml_vint(f, True)
+    if element is None:
+      return
+    (element_id, _) = element
+    size_vint = read_ebml_vint(f, False)
+    if size_vint is None:
+      raise BitstreamError("Truncated EBML element.")
+    (size, unknown_size) = size_vint
+    if element_id in EBML_MASTER_ELEMENTS:
+      continue
+    if unknown_size:
+      raise BitstreamError("Element 0x%x has unknown size." % element_id)
+    if element_id not in [EBML_CODEC_ID, EBML_SIMPLE_BLOCK, EBML_BLOCK]:
+      f.seek(size, os.SEEK_CUR)
+      continue
+    data = f.read(size)
+    if len(data) < size:
+      raise BitstreamError("Truncated EBML element 0x%x." % element_id)
+    if element_id == EBML_CODEC_ID:
+      codec = codec or WEBM_CODEC_IDS.get(data.rstrip('\x00'))
+      continue
+    # Block header: track number, 16-bit timecode and flags.
+    (block_track, header_size) = webm_block_track(data)
+    if track is None:
+      track = block_track
+    if block_track != track:
+      continue
+    if len(data) < header_size + 3:
+      raise BitstreamError("Truncated block header.")
+    flags = ord(data[header_size + 2])
+    if flags & 0x06:
+      raise BitstreamError("Laced blocks are not supported.")
+    frame = data[header_size + 3:]
+    (frame_type, temporal_layer) = frame_info(codec, frame)
+    if element_id == EBML_SIMPLE_BLOCK and frame_type is None:
+      frame_type = 'key' if flags & 0x80 else 'inter'
+    yield (len(frame), frame_type, temporal_layer)
+
+
+def webm_block_track(data):
+  if not data:
+    raise BitstreamError("Empty block.")
+  first = ord(data[0])
+  length = 1
+  while length <= 8 and not first & (0x80 >> (length - 1)):
+    length += 1
+  if length > 8 or len(data) < length:
+    raise BitstreamError("Invalid block track number.")
+  track = first & ((0x80 >> (length - 1)) - 1)
+  for c in data[1:length]:
+    track = (track << 8) | ord(c)
+  return (track, length)
+
+
+def read_annexb_frames(f):
+  """Yields access units of an H.264 Annex B byte stream.
+
+  Frame sizes include start codes, so that they add up to the file size.
+  """
+  if os.fstat(f.fileno()).st_size == 0:
+    return
+  data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    (frame_start, frame_type, temporal_layer, has_slices) = (0, None, None, False)
+    start_code = data.find('\x00\x00\x01')
+    while start_code >= 0:
+      nal = start_code + 3
+      next_start_code = data.find('\x00\x00\x01', nal)
+      # A zero byte before a start code belongs to the next NAL unit.
+      nal_start = start_code - 1 if start_code > 0 and data[start_code - 1] == '\x00' else start_code
+      if nal >= len(data):
+        break
+      nal_type = ord(data[nal]) & 0x1f
+      is_slice = nal_type in [H264_NAL_SLICE, H264_NAL_IDR_SLICE]
+      # first_mb_in_slice is 0 for the first slice of a picture, coded as a
+      # single set bit.
+      new_picture = is_slice and nal + 1 < len(data) and ord(data[nal + 1]) & 0x80
+      if has_slices and (nal_type in H264_AU_START_NALS or new_picture):
+        yield (nal_start - frame_start, frame_type, temporal_layer)
+        (frame_start, frame_type, temporal_layer, has_slices) = (nal_start, None, None, False)
+      if nal_type in [H264_NAL_PREFIX, H264_NAL_SLICE_EXTENSION] and nal + 3 < len(data):
+        # The SVC extension header carries the temporal ID.
+        temporal_layer = ord(data[nal + 3]) >> 5
+      if is_slice:
+        has_slices = True
+        if nal_type == H264_NAL_IDR_SLICE:
+          frame_type = 'key'
+        elif frame_type is None:
+          frame_type = 'inter'
+      start_code = next_start_code
+    if has_slices:
+      yield (len(data) - frame_start, frame_type, temporal_layer)
+  finally:
+    data.close()
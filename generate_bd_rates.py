@@ -0,0 +1,258 @@
+#!/usr/bin/env python2
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Computes Bjontegaard rate (BD-rate) and metric (BD-metric) differences of
+# every encoder against an anchor encoder from data files generated using
+# generate_data.py. All curves are fitted and integrated at once.
+
+import argparse
+import csv
+import json
+import math
+import sys
+
+import numpy
+
+import results_file
+
+default_metrics = [
+  'vpx-ssim',
+  'ssim',
+  'ssim-y',
+  'avg-psnr',
+  'avg-psnr-y',
+  'glb-psnr',
+  'glb-psnr-y',
+  'vmaf',
+]
+
+# Bjontegaard fits use cubic polynomials, which need at least 4 points.
+MIN_POINTS = 4
+
+def encoder_codec(value):
+  if len(value.split(':')) != 2:
+    raise argparse.ArgumentTypeError("'%s' is not of the form ENCODER:CODEC.\n" % value)
+  return value
+
+def metric_list(metrics):
+  return metrics.split(',')
+
+
+parser = argparse.ArgumentParser(description='Compute BD-rate and BD-metric differences from data files.')
+parser.add_argument('graph_files', nargs='+', metavar='graph_file.txt', type=argparse.FileType('r'))
+parser.add_argument('--anchor', required=True, metavar='ENCODER:CODEC', type=encoder_codec, help='encoder to compare other encoders against')
+parser.add_argument('--exclude-flagged', action='store_true', help='leave flagged curves out of averages')
+parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+parser.add_argument('--metrics', type=metric_list, metavar='ssim,avg-psnr,...', default=default_metrics, help='comma-separated list of metrics to compare')
+parser.add_argument('--out', required=True, metavar='summary.csv', type=argparse.FileType('w'))
+parser.add_argument('--utilization-tolerance', type=float, default=0.2, help='flag curves with points whose bitrate utilization is further than this from 1.0')
+
+curve_fields = ['input-file', 'layer-pattern', 'bitrate-config', 'temporal-layer', 'metric', 'anchor', 'encoder', 'bd-rate', 'bd-metric', 'clips', 'flags']
+
+def normalize_bitrate_config_string(config):
+  return ":".join([str(int(x * 100.0 / config[-1])) for x in config])
+
+
+def load_curves(graph_files, metrics):
+  """Groups results into rate/quality curves.
+
+  Returns a dict keyed on (input-file, layer-pattern, bitrate-config,
+  temporal-layer, metric), where input-file includes the frame window (see
+  results_file.clip_name()) with a dict of curves for each encoder:codec pair.
+  Curves are lists of (target bitrate, actual bitrate, metric value,
+  utilization) sorted on target bitrate.
+  """
+  curves = {}
+  for f in graph_files:
+    for result in results_file.read_results(f):
+      if result['actual-bitrate-bps'] <= 0:
+        continue
+      # Windows of a clip are compared separately.
+      graph_info = (results_file.clip_name(result), result['layer-pattern'], normalize_bitrate_config_string(result['bitrate-config-kbps']), result['temporal-layer'])
+      encoder = '%s:%s' % (result['encoder'], result['codec'])
+      for metric in metrics:
+        if metric not in result:
+          continue
+        point = (result['target-bitrate-bps'], result['actual-bitrate-bps'], result[metric], result['bitrate-utilization'])
+        curves.setdefault(graph_info + (metric,), {}).setdefault(encoder, []).append(point)
+  for encoder_curves in curves.itervalues():
+    for points in encoder_curves.itervalues():
+      points.sort()
+  return curves
+
+
+def curve_flags(points, utilization_tolerance):
+  flags = []
+  if len(points) < MIN_POINTS:
+    flags.append('too-few-points')
+  bitrates = [point[1] for point in points]
+  values = [point[2] for point in points]
+  # Fitting bitrate as a function of quality assumes both increase together.
+  if any(b <= a for (a, b) in zip(bitrates, bitrates[1:])) or any(b < a for (a, b) in zip(values, values[1:])):
+    flags.append('non-monotonic')
+  if any(abs(point[3] - 1.0) > utilization_tolerance for point in points):
+    flags.append('poor-utilization')
+  return flags
+
+
+def pad_curves(curves):
+  """Stacks curves of different lengths into (curves, points) arrays.
+
+  Returns (log10 bitrates, metric values, mask of valid points).
+  """
+  num_points = max(len(points) for points in curves)
+  log_bitrates = numpy.zeros((len(curves), num_points))
+  values = numpy.zeros((len(curves), num_points))
+  mask = numpy.zeros((len(curves), num_points))
+  for (i, points) in enumerate(curves):
+    log_bitrates[i, :len(points)] = numpy.log10([point[1] for point in points])
+    values[i, :len(points)] = [point[2] for point in points]
+    mask[i, :len(points)] = 1
+  return (log_bitrates, values, mask)
+
+
+def fit_cubics(x, y, mask):
+  """Least-squares cubic fits of y(x) for a batch of curves.
+
+  Arrays have shape (curves, points), points where |mask| is 0 are ignored.
+  Returns coefficients of shape (curves, 4), lowest order first.
+  """
+  vandermonde = numpy.power(x[:, :, numpy.newaxis], numpy.arange(4)) * mask[:, :, numpy.newaxis]
+  return numpy.matmul(numpy.linalg.pinv(vandermonde), (y * mask)[:, :, numpy.newaxis])[:, :, 0]
+
+
+def integrate_cubics(coefficients, lower, upper):
+  powers = numpy.arange(1, 5)
+  antiderivatives = coefficients / powers
+  return (antiderivatives * (upper[:, numpy.newaxis] ** powers - lower[:, numpy.newaxis] ** powers)).sum(axis=1)
+
+
+def bd_differences(anchor_x, anchor_y, anchor_mask, test_x, test_y, test_mask):
+  """Average distance between fitted test and anchor curves.
+
+  Distances are averaged over the x range covered by both curves, curves that
+  don't overlap get NaN.
+  """
+  lower = numpy.maximum(numpy.where(anchor_mask > 0, anchor_x, numpy.inf).min(axis=1), numpy.where(test_mask > 0, test_x, numpy.inf).min(axis=1))
+  upper = numpy.minimum(numpy.where(anchor_mask > 0, anchor_x, -numpy.inf).max(axis=1), numpy.where(test_mask > 0, test_x, -numpy.inf).max(axis=1))
+  overlapping = upper > lower
+  # Fit in coordinates where the overlap is [-1, 1] for numerical stability.
+  # The average distance doesn't change under this mapping.
+  center = numpy.where(overlapping, (upper + lower) / 2, 0)[:, numpy.newaxis]
+  half_width = numpy.where(overlapping, (upper - lower) / 2, 1)[:, numpy.newaxis]
+  anchor_fit = fit_cubics((anchor_x - center) / half_width * anchor_mask, anchor_y, anchor_mask)
+  test_fit = fit_cubics((test_x - center) / half_width * test_mask, test_y, test_mask)
+  ones = numpy.ones(len(lower))
+  distances = (integrate_cubics(test_fit, -ones, ones) - integrate_cubics(anchor_fit, -ones, ones)) / 2
+  return numpy.where(overlapping, distances, numpy.nan)
+
+
+def bd_rates_and_metrics(anchor_curves, test_curves):
+  """Returns arrays of BD-rate (percent) and BD-metric for pairs of curves."""
+  (anchor_rates, anchor_values, anchor_mask) = pad_curves(anchor_curves)
+  (test_rates, test_values, test_mask) = pad_curves(test_curves)
+  with numpy.errstate(invalid='ignore'):
+    log_rate_differences = bd_differences(anchor_values, anchor_rates, anchor_mask, test_values, test_rates, test_mask)
+    bd_rates = (numpy.power(10, log_rate_differences) - 1) * 100
+    bd_metrics = bd_differences(anchor_rates, anchor_values, anchor_mask, test_rates, test_values, test_mask)
+  return (bd_rates, bd_metrics)
+
+
+def compare_curves(curves, anchor, utilization_tolerance):
+  """Compares all curves against the anchor's, returns a row for each."""
+  rows = []
+  anchor_curves = []
+  test_curves = []
+  for graph_info in sorted(curves.keys()):
+    encoder_curves = curves[graph_info]
+    if anchor not in encoder_curves:
+      continue
+    anchor_flags = ['anchor-%s' % flag for flag in curve_flags(encoder_curves[anchor], utilization_tolerance)]
+    for encoder in sorted(encoder_curves.keys()):
+      if encoder == anchor:
+        continue
+      flags = anchor_flags + curve_flags(encoder_curves[encoder], utilization_tolerance)
+      rows.append(dict(zip(curve_fields, graph_info + (anchor, encoder, None, None, 1, ' '.join(flags)))))
+      anchor_curves.append(encoder_curves[anchor])
+      test_curves.append(encoder_curves[encoder])
+  if not rows:
+    return rows
+
+  (bd_rates, bd_metrics) = bd_rates_and_metrics(anchor_curves, test_curves)
+  for (row, anchor_points, test_points, bd_rate, bd_metric) in zip(rows, anchor_curves, test_curves, bd_rates, bd_metrics):
+    # Too few points to fit a cubic, the fit would be meaningless.
+    if len(anchor_points) < MIN_POINTS or len(test_points) < MIN_POINTS:
+      continue
+    if not math.isnan(bd_rate):
+      row['bd-rate'] = float(bd_rate)
+    if not math.isnan(bd_metric):
+      row['bd-metric'] = float(bd_metric)
+    if row['bd-rate'] is None and row['bd-metric'] is None:
+      row['flags'] = ' '.join(filter(None, [row['flags'], 'no-overlap']))
+  return rows
+
+
+def average_rows(rows, exclude_flagged):
+  """Averages differences across clips for each configuration and metric."""
+  groups = {}
+  for row in rows:
+    if exclude_flagged and row['flags']:
+      continue
+    key = tuple(row[field] for field in ['layer-pattern', 'bitrate-config', 'temporal-layer', 'metric', 'anchor', 'encoder'])
+    groups.setdefault(key, []).append(row)
+  averages = []
+  for key in sorted(groups.keys()):
+    group = groups[key]
+    average = dict(zip(['layer-pattern', 'bitrate-config', 'temporal-layer', 'metric', 'anchor', 'encoder'], key))
+    average['input-file'] = '*'
+    average['flags'] = ''
+    for field in ['bd-rate', 'bd-metric']:
+      values = [row[field] for row in group if row[field] is not None]
+      average[field] = sum(values) / len(values) if values else None
+    average['clips'] = len([row for row in group if row['bd-rate'] is not None])
+    averages.append(average)
+  return averages
+
+
+def write_csv(f, rows, averages):
+  writer = csv.DictWriter(f, curve_fields)
+  writer.writeheader()
+  for row in rows + averages:
+    writer.writerow(dict((field, '' if value is None else value) for (field, value) in row.iteritems()))
+
+
+def main():
+  args = parser.parse_args()
+  curves = load_curves(args.graph_files, args.metrics)
+  rows = compare_curves(curves, args.anchor, args.utilization_tolerance)
+  if not rows:
+    sys.exit("ERROR: No curves to compare against '%s'." % args.anchor)
+  averages = average_rows(rows, args.exclude_flagged)
+
+  if args.format == 'json':
+    json.dump({'curves': rows, 'averages': averages}, args.out, indent=2, sort_keys=True)
+    args.out.write('\n')
+  else:
+    write_csv(args.out, rows, averages)
+
+  print "Compared %d curves against %s, %d flagged." % (len(rows), args.anchor, len([row for row in rows if row['flags']]))
+  for average in averages:
+    print "%s %s tl%d %s %s: BD-rate %s, BD-%s %s (%d clips)" % (average['layer-pattern'], average['bitrate-config'], average['temporal-layer'], average['metric'], average['encoder'],
+        '%.2f%%' % average['bd-rate'] if average['bd-rate'] is not None else 'n/a', average['metric'],
+        '%.4f' % average['bd-metric'] if average['bd-metric'] is not None else 'n/a', average['clips'])
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
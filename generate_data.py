@@ -14,42 +14,90 @@
 # limitations under the License.
 
 import argparse
+import array
 import csv
+import hashlib
 import json
+import math
+import mmap
 import multiprocessing
+import multiprocessing.pool
 import os
-import pprint
+import Queue
+import random
 import re
 import shutil
+import SocketServer
 import subprocess
 import sys
 import tempfile
 import threading
 import time
+import traceback
+
+import bitrate_search
+import bitstream
+import result_cache
+import results_file
+import y4m
+try:
+  import yuv_metrics
+except ImportError:
+  # NumPy is only required for --metrics-engine=numpy.
+  yuv_metrics = None
 
 libvpx_threads = 4
 
 binary_absolute_paths = {}
 
-def find_absolute_path(use_system_path, binary):
-  global binary_absolute_paths
+class SetupError(Exception):
+  """Raised when arguments or missing binaries keep jobs from running."""
+
+
+def find_executable(binary):
+  for path in os.environ["PATH"].split(os.pathsep):
+    target = os.path.join(path.strip('"'), binary)
+    if os.path.isfile(target) and os.access(target, os.X_OK):
+      return target
+  return None
+
+def find_absolute_path(use_system_path, binary, log=None):
+  """Returns the path of |binary|, raises SetupError if it's missing.
+
+  A warning is passed to |log| when falling back on a locally-compiled binary.
+  """
   if binary in binary_absolute_paths:
     return binary_absolute_paths[binary]
 
   if use_system_path:
-    for path in os.environ["PATH"].split(os.pathsep):
-      target = os.path.join(path.strip('"'), os.path.basename(binary))
-      if os.path.isfile(target) and os.access(target, os.X_OK):
-        binary_absolute_paths[binary] = target
-        return target
+    target = find_executable(os.path.basename(binary))
+    if target:
+      binary_absolute_paths[binary] = target
+      return target
   target = os.path.join(os.path.dirname(os.path.abspath(__file__)), binary)
   if os.path.isfile(target) and os.access(target, os.X_OK):
-    if use_system_path:
-      print "WARNING: '%s' not in PATH (using --use-system-path), falling back on locally-compiled binary." % os.path.basename(binary)
+    if use_system_path and log:
+      log("WARNING: '%s' not in PATH (using --use-system-path), falling back on locally-compiled binary." % os.path.basename(binary))
     binary_absolute_paths[binary] = target
     return target
 
-  sys.exit("ERROR: '%s' missing, did you run the corresponding setup script?" % (os.path.basename(binary) if use_system_path else target))
+  raise SetupError("'%s' missing, did you run the corresponding setup script?" % (os.path.basename(binary) if use_system_path else target))
+
+def file_sha1sum(path):
+  sha1 = hashlib.sha1()
+  # hashlib releases the GIL while hashing large blocks, so files can be hashed
+  # in parallel threads.
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(8 * 1024 * 1024), ''):
+      sha1.update(block)
+  return sha1.hexdigest()
+
+binary_sha1sums = {}
+
+def binary_sha1sum(path):
+  if path not in binary_sha1sums:
+    binary_sha1sums[path] = file_sha1sum(path)
+  return binary_sha1sums[path]
 
 def aom_command(job, temp_dir):
   assert job['num_spatial_layers'] == 1
@@ -97,6 +145,7 @@ def aom_command(job, temp_dir):
     '--width=%d' % clip['width'],
     '--height=%d' % clip['height'],
     '--output=%s' % encoded_filename,
+  ] + window_params(clip) + [
     clip['yuv_file'],
   ]
   encoded_files = [{'spatial-layer': 0, 'temporal-layer': 0, 'filename': encoded_filename}]
@@ -115,7 +164,7 @@ def libvpx_tl_command(job, temp_dir):
 
   command = [
       'libvpx/examples/vpx_temporal_svc_encoder',
-      clip['yuv_file'],
+      clip_input_file(job, temp_dir),
       outfile_prefix,
       job['codec'],
       clip['width'],
@@ -191,6 +240,7 @@ def libvpx_command(job, temp_dir):
     '--width=%d' % clip['width'],
     '--height=%d' % clip['height'],
     '--output=%s' % encoded_filename,
+  ] + window_params(clip) + [
     clip['yuv_file']
   ]
   encoded_files = [{'spatial-layer': 0, 'temporal-layer': 0, 'filename': encoded_filename}]
@@ -220,7 +270,7 @@ def openh264_command(job, temp_dir):
     '-sw', clip['width'],
     '-sh', clip['height'],
     '-frin', clip['fps'],
-    '-org', clip['yuv_file'],
+    '-org', clip_input_file(job, temp_dir),
     '-bf', encoded_filename,
     '-numl', 1,
     '-dw', 0, clip['width'],
@@ -251,7 +301,7 @@ def yami_command(job, temp_dir):
     '--ipperiod', 1,
     '--intraperiod', 3000,
     '-c', job['codec'].upper(),
-    '-i', clip['yuv_file'],
+    '-i', clip_input_file(job, temp_dir),
     '-W', clip['width'],
     '-H', clip['height'],
     '-f', fps,
@@ -268,15 +318,45 @@ encoder_commands = {
   'yami' : yami_command,
 }
 
+# Number of cores each encoder keeps busy.
+encoder_threads = {
+  'aom-good' : 1,
+  'openh264' : 1,
+  'libvpx-rt' : libvpx_threads,
+  'yami' : 1,
+}
+
+# Rough encode time (ms) per pixel and frame, used to order jobs when there's no
+# history to go by. Only the relative magnitudes matter.
+default_encode_ms_per_pixel = {
+  'aom-good' : 1e-3,
+  'openh264' : 2e-5,
+  'libvpx-rt' : 2e-5,
+  'yami' : 1e-5,
+}
+
 
 yuv_clip_pattern = re.compile(r"^(.*[\._](\d+)_(\d+).yuv):(\d+)$")
+clip_window_pattern = re.compile(r"^(.*)@(\d+)(?:\+(\d+))?$")
 def clip_arg(clip):
+  # Clips can be restricted to a window of frames using the CLIP@OFFSET+COUNT
+  # suffix, otherwise --frame-offset and --num-frames apply.
+  window = {}
+  window_match = clip_window_pattern.match(clip)
+  if window_match:
+    clip = window_match.group(1)
+    window['frame_offset'] = int(window_match.group(2))
+    if window_match.group(3):
+      window['num_frames'] = positive_int(window_match.group(3))
+
   (file_root, file_ext) = os.path.splitext(clip)
   if file_ext == '.y4m':
-    width = int(subprocess.check_output(["mediainfo", "--Inform=Video;%Width%", clip]))
-    height = int(subprocess.check_output(["mediainfo", "--Inform=Video;%Height%", clip]))
-    fps = float(subprocess.check_output(["mediainfo", "--Inform=Video;%FrameRate%", clip]))
-    return {'input_file': clip, 'height': height, 'width': width, 'fps': fps, 'file_type': 'y4m'}
+    try:
+      info = y4m.read_info(clip)
+    except (IOError, y4m.Y4mError) as e:
+      raise argparse.ArgumentTypeError("Can't read '%s': %s\n" % (clip, e))
+    # .y4m clips are read directly, skipping over stream and frame headers.
+    return dict({'input_file': clip, 'height': info['height'], 'width': info['width'], 'fps': float(info['fps_num']) / info['fps_den'], 'fps_num': info['fps_num'], 'fps_den': info['fps_den'], 'header_size': info['header_size'], 'frame_header_size': info['frame_header_size'], 'file_type': 'y4m'}, **window)
 
   # Make sure YUV files are correctly formatted + look readable before actually
   # running the script on them.
@@ -286,7 +366,7 @@ def clip_arg(clip):
   input_file = clip_match.group(1)
   if not os.path.isfile(input_file) or not os.access(input_file, os.R_OK):
     raise argparse.ArgumentTypeError("'%s' is either not a file or cannot be opened for reading.\n" % input_file)
-  return {'input_file': clip_match.group(1), 'width': int(clip_match.group(2)), 'height': int(clip_match.group(3)), 'fps' : float(clip_match.group(4)), 'file_type': 'yuv'}
+  return dict({'input_file': clip_match.group(1), 'width': int(clip_match.group(2)), 'height': int(clip_match.group(3)), 'fps' : float(clip_match.group(4)), 'header_size': 0, 'frame_header_size': 0, 'file_type': 'yuv'}, **window)
 
 
 def encoder_pairs(string):
@@ -308,60 +388,331 @@ def writable_dir(directory):
   return directory
 
 
+def server_address(address):
+  (host, _, port) = address.rpartition(':')
+  try:
+    return (host, int(port))
+  except ValueError:
+    raise argparse.ArgumentTypeError("'%s' is not a valid [HOST:]PORT address.\n" % address)
+
+
+def quality_targets(targets):
+  try:
+    return [float(target) for target in targets.split(',')]
+  except ValueError:
+    raise argparse.ArgumentTypeError("'%s' is not a comma-separated list of numbers.\n" % targets)
+
 def positive_int(num):
   num_int = int(num)
   if num_int <= 0:
     raise argparse.ArgumentTypeError("'%d' is not a positive integer.\n" % num)
   return num_int
 
+def non_negative_int(num):
+  num_int = int(num)
+  if num_int < 0:
+    raise argparse.ArgumentTypeError("'%s' is not a non-negative integer.\n" % num)
+  return num_int
+
+
+# Temporary files here are kept in memory where available.
+memory_temp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
 
 parser = argparse.ArgumentParser(description='Generate graph data for video-quality comparison.')
-parser.add_argument('clips', nargs='+', metavar='clip_WIDTH_HEIGHT.yuv:FPS|clip.y4m', type=clip_arg)
+parser.add_argument('clips', nargs='+', metavar='clip_WIDTH_HEIGHT.yuv:FPS|clip.y4m[@OFFSET[+COUNT]]', type=clip_arg)
+parser.add_argument('--adaptive-ladder', action='store_true', help='choose bitrates per clip and encoder based on the quality of previous encodes')
+parser.add_argument('--benchmark', action='store_true', help='time encoders one job at a time, pinned to cores, without computing metrics')
+parser.add_argument('--benchmark-runs', default=5, type=positive_int, metavar='RUNS', help='timed encoder runs per job with --benchmark')
+parser.add_argument('--benchmark-warmup', default=1, type=non_negative_int, metavar='RUNS', help='untimed encoder runs per job before timing with --benchmark')
+parser.add_argument('--cache-dir', default=None, type=writable_dir, help='directory for caching results of previously-run jobs')
+parser.add_argument('--cache-max-size', default=1024, type=positive_int, metavar='MB', help='evict least-recently-used cache entries above this size')
+parser.add_argument('--cost-history', action='append', default=[], metavar='results.txt', type=argparse.FileType('r'), help='results of previous runs used to estimate job durations (can be repeated)')
+parser.add_argument('--decode-workers', default=0, type=positive_int, help='threads decoding layers of encoded jobs, pipelined with encoding (default: decode in the encoding worker)')
+parser.add_argument('--disk-budget', default=None, type=positive_int, metavar='MB', help='temp disk space jobs may use at once (default: free space when the run starts)')
 parser.add_argument('--dump-commands', action='store_true')
 parser.add_argument('--enable-vmaf', action='store_true')
 parser.add_argument('--encoded-file-dir', default=None, type=writable_dir)
 parser.add_argument('--encoders', required=True, metavar='encoder:codec,encoder:codec...', type=encoder_pairs)
+parser.add_argument('--fingerprint-index', default=None, metavar='index.json', help='where to remember clip SHA1s between runs (default: next to --out)')
 parser.add_argument('--frame-offset', default=0, type=positive_int)
+parser.add_argument('--ladder-metric', default='avg-psnr', choices=['avg-psnr', 'avg-psnr-y', 'glb-psnr', 'glb-psnr-y', 'ssim', 'ssim-y', 'vpx-ssim', 'vmaf'], help='quality metric used by --adaptive-ladder')
+parser.add_argument('--lease-timeout', default=60, type=positive_int, metavar='SECONDS', help='re-queue jobs of remote workers that stop responding for this long')
+parser.add_argument('--max-encodes', default=8, type=positive_int, help='encodes per clip and encoder with --adaptive-ladder')
+parser.add_argument('--memory-budget', default=None, type=positive_int, metavar='MB', help='memory (in /dev/shm) that job temp files and --reference-pool copies may use at once, files that don\'t fit go to disk (default: 0, so everything goes to disk, or all free memory with --benchmark)')
+parser.add_argument('--metric-sampling', default=0, type=positive_int, metavar='FRAMES', help='compute metrics on this many frames per layer, picked across the layer, and report confidence intervals (default: all frames)')
+parser.add_argument('--metrics-engine', default='tiny_ssim', choices=['tiny_ssim', 'numpy'], help='compute SSIM/PSNR using libvpx tiny_ssim or in-process using NumPy')
+parser.add_argument('--metrics-workers', default=0, type=positive_int, help='threads computing SSIM/PSNR and VMAF of decoded layers (default: in the decoding thread)')
 parser.add_argument('--num-frames', default=-1, type=positive_int)
 # TODO(pbos): Add support for multiple spatial layers.
 parser.add_argument('--num-spatial-layers', type=int, default=1, choices=[1])
 parser.add_argument('--num-temporal-layers', type=int, default=1, choices=[1,2,3])
+parser.add_argument('--pin-cores', action='store_true', help='pin encoders to the cores allocated to them (requires taskset)')
 parser.add_argument('--out', required=True, metavar='output.txt', type=argparse.FileType('w'))
+parser.add_argument('--quality-targets', default=[], type=quality_targets, metavar='Q,Q...', help='with --adaptive-ladder, search for bitrates reaching these qualities instead of sampling the whole curve')
+parser.add_argument('--quality-tolerance', default=0.5, type=float, help='with --adaptive-ladder, how close to targets (or to the interpolated curve) results need to be')
+parser.add_argument('--reference-pool', action='store_true', help='share one raw copy of each clip window between metric computations')
+parser.add_argument('--serve', default=None, type=server_address, metavar='[HOST:]PORT', help='serve jobs to remote workers (see generate_data_worker.py)')
+parser.add_argument('--stream-decode', action='store_true', help='compute metrics while decoding without writing decoded files to disk')
 parser.add_argument('--use-system-path', action='store_true')
 parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
 
 
-def prepare_clips(args, temp_dir):
-  clips = args.clips
-  y4m_clips = [clip for clip in clips if clip['file_type'] == 'y4m']
-  if y4m_clips:
-    print "Converting %d .y4m clip%s..." % (len(y4m_clips), "" if len(y4m_clips) == 1 else "s")
-    for clip in y4m_clips:
-      (fd, yuv_file) = tempfile.mkstemp(dir=temp_dir, suffix=".%d_%d.yuv" % (clip['width'], clip['height']))
-      os.close(fd)
-      with open(os.devnull, 'w') as devnull:
-        subprocess.check_call(['ffmpeg', '-y', '-i', clip['input_file'], yuv_file], stdout=devnull, stderr=devnull)
-      clip['yuv_file'] = yuv_file
+def fingerprint_index_file(args):
+  if args.fingerprint_index:
+    return args.fingerprint_index
+  return os.path.join(os.path.dirname(os.path.abspath(args.out.name)), '.clip-fingerprints.json')
+
+
+def fingerprint_clips(clips, index_file, workers, log):
+  """Fills in clip['sha1sum'], reusing hashes of unchanged files.
+
+  Hashes are stored in |index_file| keyed on path, size, mtime and inode, so
+  only new or modified clips are hashed (in parallel) on later runs. Progress
+  is passed to |log|.
+  """
+  try:
+    with open(index_file) as f:
+      index = json.load(f)
+  except (IOError, ValueError):
+    index = {}
+
+  def file_key(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime, stat.st_ino]
+
+  paths = sorted(set(os.path.abspath(clip['input_file']) for clip in clips))
+  missing = [path for path in paths if path not in index or index[path]['key'] != file_key(path)]
+  if missing:
+    log("Hashing %d clip%s..." % (len(missing), "" if len(missing) == 1 else "s"))
+    pool = multiprocessing.pool.ThreadPool(max(1, min(workers, len(missing))))
+    sha1sums = pool.map(file_sha1sum, missing)
+    pool.close()
+    for (path, sha1sum) in zip(missing, sha1sums):
+      index[path] = {'key': file_key(path), 'sha1sum': sha1sum}
+    try:
+      (fd, temp_file) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_file)), suffix='.tmp')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+      os.rename(temp_file, index_file)
+    except (IOError, OSError) as e:
+      log("WARNING: Could not update clip fingerprint index '%s': %s" % (index_file, e))
+
   for clip in clips:
-    clip['sha1sum'] = subprocess.check_output(['sha1sum', clip['input_file']]).split(' ', 1)[0]
-    if 'yuv_file' not in clip:
-      clip['yuv_file'] = clip['input_file']
-    frame_size = 6 * clip['width'] * clip['height'] / 4
-    input_yuv_filesize = os.path.getsize(clip['yuv_file'])
-    clip['input_total_frames'] = input_yuv_filesize / frame_size
-    # Truncate file if necessary.
-    if args.frame_offset > 0 or args.num_frames > 0:
-      (fd, truncated_filename) = tempfile.mkstemp(dir=temp_dir, suffix=".yuv")
-      blocksize = 2048 * 1024
-      total_filesize = args.num_frames * frame_size
-      with os.fdopen(fd, 'wb', blocksize) as truncated_file:
-        with open(clip['yuv_file'], 'rb') as original_file:
-          original_file.seek(args.frame_offset * frame_size)
-          while total_filesize > 0:
-            data = original_file.read(blocksize if blocksize < total_filesize else total_filesize)
-            truncated_file.write(data)
-            total_filesize -= blocksize
-      clip['yuv_file'] = truncated_filename
+    clip['sha1sum'] = str(index[os.path.abspath(clip['input_file'])]['sha1sum'])
+
+
+def prepare_clips(run):
+  args = run.args
+  fingerprint_clips(args.clips, fingerprint_index_file(args), args.workers, run.log)
+  for clip in args.clips:
+    clip['yuv_file'] = clip['input_file']
+    frame_stride = clip['frame_header_size'] + clip_frame_size(clip)
+    clip['input_total_frames'] = (os.path.getsize(clip['yuv_file']) - clip['header_size']) / frame_stride
+    # Frame windows are read directly from the original file, see
+    # clip_input_file().
+    clip.setdefault('frame_offset', args.frame_offset)
+    available_frames = max(clip['input_total_frames'] - clip['frame_offset'], 0)
+    num_frames = clip.get('num_frames', args.num_frames)
+    clip['num_frames'] = available_frames if num_frames < 0 else min(num_frames, available_frames)
+    if clip['num_frames'] == 0:
+      # Encoders read --limit=0 as no limit, and rates per frame divide by it.
+      raise SetupError("The frame window of '%s' starting at frame %d is empty, the clip has %d frames." % (clip['input_file'], clip['frame_offset'], clip['input_total_frames']))
+
+
+def clip_frame_size(clip):
+  # Chroma planes of odd-sized frames are rounded up, as in .y4m files.
+  return y4m.frame_size(clip)
+
+
+def clip_frame_position(clip, frame):
+  frame_stride = clip['frame_header_size'] + clip_frame_size(clip)
+  return clip['header_size'] + frame * frame_stride + clip['frame_header_size']
+
+
+def clip_is_windowed(clip):
+  return clip['frame_offset'] > 0 or clip['num_frames'] < clip['input_total_frames']
+
+
+def clip_needs_feed(clip):
+  # Raw I420 consumers need .y4m headers stripped.
+  return clip['file_type'] == 'y4m' or clip_is_windowed(clip)
+
+
+def window_params(clip):
+  # vpxenc and aomenc read .y4m files and frame windows from the original file
+  # directly.
+  if not clip_is_windowed(clip):
+    return []
+  return ['--skip=%d' % clip['frame_offset'], '--limit=%d' % clip['num_frames']]
+
+
+def make_fifo(temp_dir, suffix):
+  (fd, fifo) = tempfile.mkstemp(dir=temp_dir, suffix=suffix)
+  os.close(fd)
+  os.remove(fifo)
+  os.mkfifo(fifo)
+  return fifo
+
+
+def clip_input_file(job, temp_dir):
+  """Returns a path that reads as raw I420 frames of the clip's frame window.
+
+  Windowed and .y4m clips are served through a FIFO fed from the original file
+  once the job's command starts (see run_command), so no truncated or
+  converted copy is written.
+  """
+  clip = job['clip']
+  if not clip_needs_feed(clip):
+    return clip['yuv_file']
+  fifo = make_fifo(temp_dir, '.yuv')
+  job.setdefault('input_fifos', []).append(fifo)
+  return fifo
+
+
+def write_window(clip, filename, temporal_skip):
+  frame_size = clip_frame_size(clip)
+  with open(clip['yuv_file'], 'rb') as f:
+    clip_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    with open(filename, 'wb') as out:
+      if temporal_skip == 0 and clip['frame_header_size'] == 0:
+        out.write(buffer(clip_map, clip_frame_position(clip, clip['frame_offset']), clip['num_frames'] * frame_size))
+      else:
+        # Frame headers are stripped on the fly.
+        for frame in range(0, clip['num_frames'], temporal_skip + 1):
+          out.write(buffer(clip_map, clip_frame_position(clip, clip['frame_offset'] + frame), frame_size))
+  finally:
+    clip_map.close()
+
+
+def feed_window(clip, fifo, temporal_skip):
+  try:
+    write_window(clip, fifo, temporal_skip)
+  except IOError:
+    # The reader went away before reading the whole window.
+    pass
+
+
+def start_window_feed(clip, fifo, temporal_skip=0):
+  """Serves the clip window through |fifo|, skipping frames between layers."""
+  return start_daemon(lambda: feed_window(clip, fifo, temporal_skip))
+
+
+def finish_window_feed(fifo, feeder):
+  # If the reader never opened the FIFO, the feeder is still blocked on opening
+  # it for writing. Briefly open it for reading to let the feeder finish.
+  while feeder.is_alive():
+    os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+    feeder.join(0.1)
+  os.remove(fifo)
+
+
+def clip_key(clip):
+  return (clip['input_file'], clip['frame_offset'], clip['num_frames'])
+
+
+class ReferencePool(object):
+  """Raw I420 copies of clip frame windows, shared by all jobs of a clip.
+
+  A clip's copy is written the first time a metric needs it, read by all
+  metric computations of the clip and removed once the last job using the clip
+  is finished, so each clip is read from disk once. Copies take their space
+  from |storage| like job temp dirs do.
+  """
+
+  def __init__(self, storage, jobs):
+    self.storage = storage
+    self.condition = threading.Condition()
+    self.files = {}
+    self.writing = set()
+    self.remaining_jobs = {}
+    self.add_jobs(jobs)
+
+  def add_jobs(self, jobs):
+    with self.condition:
+      for job in jobs:
+        key = clip_key(job['clip'])
+        self.remaining_jobs[key] = self.remaining_jobs.get(key, 0) + 1
+
+  def get(self, clip):
+    """Returns the path of the clip window's copy, writing it if needed."""
+    key = clip_key(clip)
+    with self.condition:
+      while key in self.writing:
+        self.condition.wait(1)
+      if key in self.files:
+        return self.files[key]
+      self.writing.add(key)
+    # Jobs already running need the copy, so it doesn't wait for space.
+    copy_dir = self.storage.acquire(clip_frame_size(clip) * clip['num_frames'], shared=True)
+    filename = os.path.join(copy_dir, 'reference.yuv')
+    try:
+      write_window(clip, filename, 0)
+    except:
+      self.storage.release(copy_dir)
+      with self.condition:
+        self.writing.discard(key)
+        self.condition.notify_all()
+      raise
+    with self.condition:
+      self.files[key] = filename
+      self.writing.discard(key)
+      self.condition.notify_all()
+    return filename
+
+  def release(self, clip):
+    """Called when a job using the clip is finished."""
+    key = clip_key(clip)
+    with self.condition:
+      self.remaining_jobs[key] -= 1
+      if self.remaining_jobs[key] == 0 and key in self.files:
+        self.storage.release(os.path.dirname(self.files.pop(key)))
+
+  def close(self):
+    with self.condition:
+      for filename in self.files.itervalues():
+        self.storage.release(os.path.dirname(filename))
+      self.files.clear()
+
+
+def clip_reference_frames(run, clip, temporal_skip):
+  # Every (temporal_skip + 1)th frame is compared, skipped frames are never
+  # read.
+  if run.reference_pool:
+    frames = yuv_metrics.map_frames(run.reference_pool.get(clip), clip['width'], clip['height'])
+  else:
+    frames = yuv_metrics.map_frames(clip['yuv_file'], clip['width'], clip['height'], clip['frame_offset'], clip['num_frames'], clip['header_size'], clip['frame_header_size'])
+  return frames[::temporal_skip + 1]
+
+
+def reference_input(run, clip, temp_dir, temporal_skip):
+  """Returns (reference file, remaining temporal skip, feeder) for metrics."""
+  if run.reference_pool:
+    return (run.reference_pool.get(clip), temporal_skip, None)
+  if not clip_needs_feed(clip):
+    return (clip['yuv_file'], temporal_skip, None)
+  fifo = make_fifo(temp_dir, '.yuv')
+  # Skipped frames are left out of the FIFO.
+  return (fifo, 0, start_window_feed(clip, fifo, temporal_skip))
+
+
+def decoder_binary(codec):
+  if codec in ['vp8', 'vp9']:
+    return 'libvpx/vpxdec'
+  elif codec == 'av1':
+    return 'aom/aomdec'
+  elif codec == 'h264':
+    return 'openh264/h264dec'
+
+
+def decoder_command(job, encoded_file, decoded_file, framestats_file):
+  if job['codec'] in ['av1', 'vp8', 'vp9']:
+    decoder = decoder_binary(job['codec'])
+    return ([decoder, '--i420', '--codec=%s' % job['codec'], '-o', decoded_file, encoded_file, '--framestats=%s' % framestats_file], framestats_file)
+  elif job['codec'] == 'h264':
+    # TODO(pbos): Generate H264 framestats. Frame sizes are parsed from the
+    # encoded file instead (see add_bitstream_results).
+    return (['openh264/h264dec', encoded_file, decoded_file], None)
 
 
 def decode_file(job, temp_dir, encoded_file):
@@ -369,37 +720,64 @@ def decode_file(job, temp_dir, encoded_file):
   os.close(fd)
   (fd, framestats_file) = tempfile.mkstemp(dir=temp_dir, suffix=".csv")
   os.close(fd)
+  (command, framestats_file) = decoder_command(job, encoded_file, decoded_file, framestats_file)
   with open(os.devnull, 'w') as devnull:
-    if job['codec'] in ['av1', 'vp8', 'vp9']:
-      decoder = 'aom/aomdec' if job['codec'] == 'av1' else 'libvpx/vpxdec'
-      subprocess.check_call([decoder, '--i420', '--codec=%s' % job['codec'], '-o', decoded_file, encoded_file, '--framestats=%s' % framestats_file], stdout=devnull, stderr=devnull)
-    elif job['codec'] == 'h264':
-      subprocess.check_call(['openh264/h264dec', encoded_file, decoded_file], stdout=devnull, stderr=devnull)
-      # TODO(pbos): Generate H264 framestats.
-      framestats_file = None
+    subprocess.check_call(command, stdout=devnull, stderr=devnull)
   return (decoded_file, framestats_file)
 
 
+# Typecodes of the arrays that per-frame series are stored in.
+framestats_typecodes = {int: 'i', float: 'd'}
+
 def add_framestats(results_dict, framestats_file, statstype):
+  # Series replace earlier ones, decoder frame sizes take precedence over the
+  # ones parsed from encoded files.
+  series = {}
   with open(framestats_file) as csvfile:
     reader = csv.DictReader(csvfile)
     for row in reader:
       for (metric, value) in row.items():
         metric_key = 'frame-%s' % metric
-        if metric_key not in results_dict:
-          results_dict[metric_key] = []
-        results_dict[metric_key].append(statstype(value))
+        if metric_key not in series:
+          series[metric_key] = array.array(framestats_typecodes[statstype])
+        series[metric_key].append(statstype(value))
+  results_dict.update(series)
 
 
-def generate_metrics(results_dict, job, temp_dir, encoded_file):
-  (decoded_file, decoder_framestats) = decode_file(job, temp_dir, encoded_file['filename'])
-  clip = job['clip']
-  temporal_divide = 2 ** (job['num_temporal_layers'] - 1 - encoded_file['temporal-layer'])
-  temporal_skip = temporal_divide - 1
-  # TODO(pbos): Perform SSIM on downscaled .yuv files for spatial layers.
+def add_bitstream_results(results_dict, encoded_file):
+  """Adds frame sizes, key frames and temporal layers parsed from the file.
+
+  Files in formats that can't be parsed are left out.
+  """
+  try:
+    frames = list(bitstream.read_frames(encoded_file))
+  except bitstream.BitstreamError:
+    return
+  results_dict['encoded-frames'] = len(frames)
+  results_dict['frame-bytes'] = array.array('i', [size for (size, frame_type, temporal_layer) in frames])
+  results_dict['key-frames'] = array.array('i', [i for (i, (size, frame_type, temporal_layer)) in enumerate(frames) if frame_type == 'key'])
+  if any(temporal_layer is not None for (size, frame_type, temporal_layer) in frames):
+    results_dict['frame-temporal-layer'] = array.array('i', [temporal_layer if temporal_layer is not None else -1 for (size, frame_type, temporal_layer) in frames])
+
+
+def tiny_ssim_command(results_dict, reference_file, decoded_file, temporal_skip, metrics_framestats):
+  return ['libvpx/tools/tiny_ssim', reference_file, decoded_file, "%dx%d" % (results_dict['width'], results_dict['height']), str(temporal_skip), metrics_framestats]
+
+
+def run_tiny_ssim(run, results_dict, clip, temp_dir, decoded_file, temporal_skip):
   (fd, metrics_framestats) = tempfile.mkstemp(dir=temp_dir, suffix=".csv")
   os.close(fd)
-  ssim_results = subprocess.check_output(['libvpx/tools/tiny_ssim', clip['yuv_file'], decoded_file, "%dx%d" % (results_dict['width'], results_dict['height']), str(temporal_skip), metrics_framestats]).splitlines()
+  (reference_file, temporal_skip, feeder) = reference_input(run, clip, temp_dir, temporal_skip)
+  try:
+    ssim_results = subprocess.check_output(tiny_ssim_command(results_dict, reference_file, decoded_file, temporal_skip, metrics_framestats))
+  finally:
+    if feeder:
+      finish_window_feed(reference_file, feeder)
+  return add_tiny_ssim_results(results_dict, ssim_results, metrics_framestats)
+
+
+def add_tiny_ssim_results(results_dict, ssim_output, metrics_framestats):
+  ssim_results = ssim_output.splitlines()
   metric_map = {
     'AvgPSNR': 'avg-psnr',
     'AvgPSNR-Y': 'avg-psnr-y',
@@ -424,21 +802,280 @@ def generate_metrics(results_dict, job, temp_dir, encoded_file):
     elif metric == 'Nframes':
       layer_frames = int(value)
       results_dict['frame-count'] = layer_frames
+  add_framestats(results_dict, metrics_framestats, float)
+  return layer_frames
+
+
+def vmaf_command(results_dict, reference_file, decoded_file):
+  return ['vmaf/run_vmaf', 'yuv420p', str(results_dict['width']), str(results_dict['height']), reference_file, decoded_file, '--out-fmt', 'json']
+
+
+def add_vmaf_results(results_dict, vmaf_output):
+  vmaf_obj = json.loads(vmaf_output)
+  results_dict['vmaf'] = float(vmaf_obj['aggregate']['VMAF_score'])
 
+  results_dict['frame-vmaf'] = array.array('d')
+  for frame in vmaf_obj['frames']:
+    results_dict['frame-vmaf'].append(frame['VMAF_score'])
+
+
+# Number of decoded frames buffered at a time when streaming metrics.
+stream_batch_frames = 8
+
+def stream_metrics(run, results_dict, job, temp_dir, encoded_file, temporal_skip):
+  """Decodes to a pipe and computes metrics while frames are decoded.
+
+  Decoded frames are read from the decoder's stdout a few frames at a time and
+  forwarded to metric consumers. Subprocess consumers (tiny_ssim, VMAF) read
+  decoded frames from FIFOs, so decoded frames never touch disk.
+  """
+  clip = job['clip']
+  width = results_dict['width']
+  height = results_dict['height']
+  (fd, framestats_file) = tempfile.mkstemp(dir=temp_dir, suffix=".csv")
+  os.close(fd)
+  (command, decoder_framestats) = decoder_command(job, encoded_file['filename'], '-' if job['codec'] != 'h264' else '/dev/stdout', framestats_file)
+
+  # Consumers are recorded as soon as their FIFOs exist, so that everything
+  # started is cleaned up if a later step fails.
+  consumers = []
+  def start_consumer(name, consumer_temporal_skip, consumer_command_fn):
+    consumer = {'name': name, 'fifo': make_fifo(temp_dir, '.yuv'), 'process': None, 'feeder': None}
+    consumers.append(consumer)
+    (consumer['reference_file'], consumer_temporal_skip, consumer['feeder']) = reference_input(run, clip, temp_dir, consumer_temporal_skip)
+    consumer['process'] = subprocess.Popen(consumer_command_fn(consumer['reference_file'], consumer_temporal_skip, consumer['fifo']), stdout=subprocess.PIPE)
+
+  decoder = None
+  fifo_files = []
+  try:
+    comparator = None
+    if run.args.metrics_engine == 'numpy':
+      comparator = yuv_metrics.FrameComparator(width, height)
+      reference = clip_reference_frames(run, clip, temporal_skip)
+    else:
+      (fd, metrics_framestats) = tempfile.mkstemp(dir=temp_dir, suffix=".csv")
+      os.close(fd)
+      start_consumer('ssim', temporal_skip, lambda reference_file, skip, fifo: tiny_ssim_command(results_dict, reference_file, fifo, skip, metrics_framestats))
+    if run.args.enable_vmaf:
+      start_consumer('vmaf', 0, lambda reference_file, skip, fifo: vmaf_command(results_dict, reference_file, fifo))
+
+    # Stages run concurrently when streaming, so each stage is timed from when
+    # decoding starts until the stage is done.
+    start_time = time.time()
+    with open(os.devnull, 'w') as devnull:
+      decoder = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=devnull)
+    # Opening a FIFO for writing blocks until its consumer opens it for reading.
+    for consumer in consumers:
+      fifo_files.append(open(consumer['fifo'], 'wb'))
+    decoded_frames = 0
+    frame_size = clip_frame_size(clip)
+    while True:
+      data = decoder.stdout.read(stream_batch_frames * frame_size)
+      if not data:
+        break
+      for f in fifo_files:
+        f.write(data)
+      if comparator:
+        frames = yuv_metrics.frames_from_buffer(data, width, height)
+        # Like tiny_ssim, stop comparing when reference frames run out.
+        reference_batch = reference[decoded_frames:decoded_frames + len(frames)]
+        if len(reference_batch) > 0:
+          comparator.add_frames(reference_batch, frames[:len(reference_batch)])
+      decoded_frames += len(data) // frame_size
+    while fifo_files:
+      fifo_files.pop().close()
+    if decoder.wait() != 0:
+      raise subprocess.CalledProcessError(decoder.returncode, command)
+    results_dict['decode-time-ms'] = (time.time() - start_time) * 1000
+
+    if decoder_framestats:
+      add_framestats(results_dict, decoder_framestats, int)
+    if comparator:
+      metrics = comparator.results()
+      if metrics is None:
+        raise Exception("No decoded frames to compare in '%s'." % encoded_file['filename'])
+      results_dict.update(metrics)
+      layer_frames = results_dict['frame-count']
+      results_dict['metrics-time-ms'] = (time.time() - start_time) * 1000
+    for consumer in consumers:
+      (output, _) = consumer['process'].communicate()
+      results_dict['%s-time-ms' % ('metrics' if consumer['name'] == 'ssim' else consumer['name'])] = (time.time() - start_time) * 1000
+      if consumer['process'].returncode != 0:
+        raise subprocess.CalledProcessError(consumer['process'].returncode, consumer['name'])
+      if consumer['name'] == 'ssim':
+        layer_frames = add_tiny_ssim_results(results_dict, output, metrics_framestats)
+      else:
+        add_vmaf_results(results_dict, output)
+    return layer_frames
+  finally:
+    processes = [process for process in [decoder] + [consumer['process'] for consumer in consumers] if process]
+    for process in processes:
+      if process.poll() is None:
+        process.kill()
+    for f in fifo_files:
+      try:
+        f.close()
+      except IOError:
+        # The consumer already went away.
+        pass
+    for process in processes:
+      process.wait()
+      process.stdout.close()
+    for consumer in consumers:
+      if consumer['feeder']:
+        finish_window_feed(consumer['reference_file'], consumer['feeder'])
+      os.remove(consumer['fifo'])
+
+
+def layer_temporal_divide(job, encoded_file):
+  return 2 ** (job['num_temporal_layers'] - 1 - encoded_file['temporal-layer'])
+
+
+def decode_layer(results_dict, job, temp_dir, encoded_file):
+  start_time = time.time()
+  (decoded_file, decoder_framestats) = decode_file(job, temp_dir, encoded_file['filename'])
+  results_dict['decode-time-ms'] = (time.time() - start_time) * 1000
   if decoder_framestats:
     add_framestats(results_dict, decoder_framestats, int)
-  add_framestats(results_dict, metrics_framestats, float)
+  return decoded_file
 
-  if args.enable_vmaf:
-    vmaf_results = subprocess.check_output(['vmaf/run_vmaf', 'yuv420p', str(results_dict['width']), str(results_dict['height']), clip['yuv_file'], decoded_file, '--out-fmt', 'json'])
-    vmaf_obj = json.loads(vmaf_results)
-    results_dict['vmaf'] = float(vmaf_obj['aggregate']['VMAF_score'])
 
-    results_dict['frame-vmaf'] = []
-    for frame in vmaf_obj['frames']:
-      results_dict['frame-vmaf'].append(frame['VMAF_score'])
+def ssim_metrics(run, results_dict, job, temp_dir, encoded_file, decoded_file):
+  """Computes SSIM/PSNR metrics of a decoded layer, returns its frame count."""
+  clip = job['clip']
+  temporal_skip = layer_temporal_divide(job, encoded_file) - 1
+  start_time = time.time()
+  if run.args.metrics_engine == 'numpy':
+    metrics = yuv_metrics.compare_files(clip_reference_frames(run, clip, temporal_skip), decoded_file, results_dict['width'], results_dict['height'])
+    if metrics is None:
+      raise Exception("No decoded frames to compare in '%s'." % encoded_file['filename'])
+    results_dict.update(metrics)
+    layer_frames = results_dict['frame-count']
+  else:
+    layer_frames = run_tiny_ssim(run, results_dict, clip, temp_dir, decoded_file, temporal_skip)
+  results_dict['metrics-time-ms'] = (time.time() - start_time) * 1000
+  return layer_frames
+
+
+def vmaf_metrics(run, results_dict, job, temp_dir, decoded_file):
+  start_time = time.time()
+  (reference_file, _, feeder) = reference_input(run, job['clip'], temp_dir, 0)
+  try:
+    add_vmaf_results(results_dict, subprocess.check_output(vmaf_command(results_dict, reference_file, decoded_file)))
+  finally:
+    if feeder:
+      finish_window_feed(reference_file, feeder)
+  results_dict['vmaf-time-ms'] = (time.time() - start_time) * 1000
+
+
+def sample_frames(clip, num_frames, num_samples):
+  """Picks one frame from each of |num_samples| equally-sized strata.
+
+  Frames are picked at random, seeded by the clip window so that every job of
+  a clip compares the same frames.
+  """
+  if num_samples >= num_frames:
+    return range(num_frames)
+  seed = hashlib.sha1(repr((clip_key(clip), num_frames, num_samples))).hexdigest()
+  generator = random.Random(int(seed[:16], 16))
+  bounds = [num_frames * i // num_samples for i in range(num_samples + 1)]
+  return [generator.randrange(bounds[i], bounds[i + 1]) for i in range(num_samples)]
+
+
+def write_frames(frames, temp_dir):
+  (fd, filename) = tempfile.mkstemp(dir=temp_dir, suffix=".yuv")
+  with os.fdopen(fd, 'wb') as f:
+    for frame in frames:
+      f.write(frame.tostring())
+  return filename
+
+
+# Aggregate metrics that are means of a per-frame series, which confidence
+# intervals can be computed for.
+sampled_metric_series = {
+  'avg-psnr': 'frame-psnr',
+  'avg-psnr-y': 'frame-psnr-y',
+  'avg-psnr-u': 'frame-psnr-u',
+  'avg-psnr-v': 'frame-psnr-v',
+  'ssim': 'frame-ssim',
+  'ssim-y': 'frame-ssim-y',
+  'ssim-u': 'frame-ssim-u',
+  'ssim-v': 'frame-ssim-v',
+}
+
+# Normal quantile for 95% confidence intervals.
+confidence_z = 1.96
+
+def add_confidence_intervals(results_dict, num_frames):
+  """Adds 95% confidence interval half-widths as '<metric>-ci' keys.
 
-  layer_fps = clip['fps'] / temporal_divide
+  Sampled frames are treated as a simple random sample of the layer's frames,
+  which is conservative for stratified samples.
+  """
+  num_samples = results_dict['metric-frame-count']
+  for (metric, series) in sampled_metric_series.iteritems():
+    if metric not in results_dict or series not in results_dict or num_samples < 2:
+      continue
+    values = results_dict[series]
+    mean = sum(values) / len(values)
+    variance = sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+    finite_population = 1.0 - float(num_samples) / num_frames
+    results_dict['%s-ci' % metric] = confidence_z * math.sqrt(variance / num_samples * finite_population)
+  if 'ssim-ci' in results_dict:
+    # vpx-ssim is a monotonic function of SSIM, map the interval's bounds.
+    ssim = results_dict['ssim']
+    bounds = [100 * math.pow(min(max(ssim + delta, 0.0), 1.0), 8.0) for delta in [-results_dict['ssim-ci'], results_dict['ssim-ci']]]
+    results_dict['vpx-ssim-ci'] = (bounds[1] - bounds[0]) / 2
+
+
+def sampled_metrics(run, results_dict, job, temp_dir, encoded_file, decoded_file):
+  """Computes metrics of a decoded layer on --metric-sampling frames only.
+
+  Sampled reference and decoded frames are copied to temporary files that
+  metric tools compare in full. VMAF is the exception, see below. Returns the
+  layer's frame count.
+  """
+  clip = job['clip']
+  (width, height) = (results_dict['width'], results_dict['height'])
+  start_time = time.time()
+  reference = clip_reference_frames(run, clip, layer_temporal_divide(job, encoded_file) - 1)
+  decoded = yuv_metrics.map_frames(decoded_file, width, height)
+  # Like tiny_ssim, stop comparing when either file runs out of frames.
+  layer_frames = min(len(reference), len(decoded))
+  if layer_frames == 0:
+    raise Exception("No decoded frames to compare in '%s'." % encoded_file['filename'])
+  frames = sample_frames(clip, layer_frames, run.args.metric_sampling)
+  reference_file = write_frames((reference[i] for i in frames), temp_dir)
+  sampled_file = write_frames((decoded[i] for i in frames), temp_dir)
+
+  if run.args.metrics_engine == 'numpy':
+    results_dict.update(yuv_metrics.compare_files(yuv_metrics.map_frames(reference_file, width, height), sampled_file, width, height))
+  else:
+    (fd, metrics_framestats) = tempfile.mkstemp(dir=temp_dir, suffix=".csv")
+    os.close(fd)
+    add_tiny_ssim_results(results_dict, subprocess.check_output(tiny_ssim_command(results_dict, reference_file, sampled_file, 0, metrics_framestats)), metrics_framestats)
+  results_dict['metrics-time-ms'] = (time.time() - start_time) * 1000
+  os.remove(reference_file)
+  os.remove(sampled_file)
+  if run.args.enable_vmaf:
+    # VMAF's motion feature compares each frame to the previous one, which
+    # sampled frames aren't, so VMAF is scored on the whole layer. Per-frame
+    # scores are only kept for sampled frames, like the other series.
+    vmaf_metrics(run, results_dict, job, temp_dir, decoded_file)
+    frame_vmaf = results_dict['frame-vmaf']
+    results_dict['frame-vmaf'] = array.array('d', [frame_vmaf[i] for i in frames])
+
+  # Per-frame metric series only cover sampled frames, indexed by these.
+  results_dict['metric-frames'] = array.array('i', frames)
+  results_dict['metric-frame-count'] = len(frames)
+  results_dict['frame-count'] = layer_frames
+  add_confidence_intervals(results_dict, layer_frames)
+  return layer_frames
+
+
+def add_layer_results(results_dict, job, encoded_file, layer_frames):
+  temporal_divide = layer_temporal_divide(job, encoded_file)
+  layer_fps = job['clip']['fps'] / temporal_divide
   results_dict['layer-fps'] = layer_fps
 
   spatial_divide = 2 ** (job['num_spatial_layers'] - 1 - encoded_file['spatial-layer'])
@@ -452,19 +1089,169 @@ def generate_metrics(results_dict, job, temp_dir, encoded_file):
   results_dict['bitrate-utilization'] = float(bitrate_used_bps) / target_bitrate_bps
 
 
-def run_command(job, (command, encoded_files), job_temp_dir, encoded_file_dir):
+def generate_metrics(run, results_dict, job, temp_dir, encoded_file):
+  # TODO(pbos): Perform SSIM on downscaled .yuv files for spatial layers.
+  if run.args.stream_decode:
+    layer_frames = stream_metrics(run, results_dict, job, temp_dir, encoded_file, layer_temporal_divide(job, encoded_file) - 1)
+  elif run.args.metric_sampling:
+    decoded_file = decode_layer(results_dict, job, temp_dir, encoded_file)
+    layer_frames = sampled_metrics(run, results_dict, job, temp_dir, encoded_file, decoded_file)
+  else:
+    decoded_file = decode_layer(results_dict, job, temp_dir, encoded_file)
+    layer_frames = ssim_metrics(run, results_dict, job, temp_dir, encoded_file, decoded_file)
+    if run.args.enable_vmaf:
+      vmaf_metrics(run, results_dict, job, temp_dir, decoded_file)
+  add_layer_results(results_dict, job, encoded_file, layer_frames)
+
+
+class CoreAllocator(object):
+  """Hands out cores so that concurrent encoders don't oversubscribe them."""
+
+  def __init__(self, num_cores):
+    self.condition = threading.Condition()
+    self.free_cores = range(num_cores)
+    self.num_cores = num_cores
+
+  def acquire(self, num_cores):
+    # Encoders using more threads than there are cores get all of them.
+    num_cores = min(num_cores, self.num_cores)
+    with self.condition:
+      while len(self.free_cores) < num_cores:
+        self.condition.wait(1)
+      cores = self.free_cores[:num_cores]
+      self.free_cores = self.free_cores[num_cores:]
+      return cores
+
+  def release(self, cores):
+    with self.condition:
+      self.free_cores = sorted(self.free_cores + cores)
+      self.condition.notify_all()
+
+
+def free_space(directory):
+  stats = os.statvfs(directory)
+  return stats.f_bavail * stats.f_frsize
+
+
+def estimate_job_footprint(run, job):
+  """Estimates the size of the files a job writes to its temp dir, in bytes."""
   clip = job['clip']
-  start_time = time.time()
+  frame_size = clip_frame_size(clip)
+  # Leave room for encoders overshooting their target bitrate.
+  footprint = sum(job['target_bitrates_kbps']) * 1000 / 8 * clip['num_frames'] / clip['fps'] * 2
+  for temporal_layer in range(job['num_temporal_layers']):
+    temporal_divide = 2 ** (job['num_temporal_layers'] - 1 - temporal_layer)
+    # Decoded layers stay around until the job is done.
+    if not run.args.stream_decode:
+      footprint += frame_size * ((clip['num_frames'] + temporal_divide - 1) // temporal_divide)
+    if run.args.metric_sampling:
+      footprint += 2 * frame_size * run.args.metric_sampling
+  # First-pass statistics, framestats and such.
+  return int(footprint) + 1024 * 1024
+
+
+class StorageManager(object):
+  """Places job temp dirs in memory or on disk within a budget for each.
+
+  Jobs go to |memory_dir| while their estimated footprint fits
+  |memory_budget|, otherwise to |disk_dir| if it fits |disk_budget|. Jobs
+  wait for other jobs to finish when neither fits, unless no job is running.
+  Shared files that running jobs need never wait, they go to disk if they
+  don't fit.
+  """
+
+  def __init__(self, disk_dir, disk_budget, memory_dir, memory_budget):
+    self.condition = threading.Condition()
+    self.disk_dir = disk_dir
+    self.memory_dir = tempfile.mkdtemp(dir=memory_dir) if memory_budget > 0 else None
+    self.budgets = {self.disk_dir: disk_budget, self.memory_dir: memory_budget}
+    self.used = {self.disk_dir: 0, self.memory_dir: 0}
+    self.job_dirs = {}
+    self.num_jobs = 0
+
+  def acquire(self, footprint, shared=False):
+    """Waits until |footprint| bytes fit, returns a new temp dir for a job.
+
+    Dirs for |shared| files are returned right away.
+    """
+    with self.condition:
+      while True:
+        candidates = [directory for directory in [self.memory_dir, self.disk_dir] if directory and self.used[directory] + footprint <= self.budgets[directory]]
+        if not candidates and (shared or not self.num_jobs):
+          # Never wait for jobs that don't fit at all, they'd wait forever.
+          candidates = [self.disk_dir]
+        if candidates:
+          break
+        self.condition.wait(1)
+      job_temp_dir = tempfile.mkdtemp(dir=candidates[0])
+      self.used[candidates[0]] += footprint
+      self.job_dirs[job_temp_dir] = (candidates[0], footprint, shared)
+      if not shared:
+        self.num_jobs += 1
+      return job_temp_dir
+
+  def release(self, job_temp_dir):
+    """Removes a job's temp dir and returns its space to the budget."""
+    shutil.rmtree(job_temp_dir, ignore_errors=True)
+    with self.condition:
+      (directory, footprint, shared) = self.job_dirs.pop(job_temp_dir)
+      self.used[directory] -= footprint
+      if not shared:
+        self.num_jobs -= 1
+      self.condition.notify_all()
+
+  def close(self):
+    if self.memory_dir:
+      shutil.rmtree(self.memory_dir, ignore_errors=True)
+
+
+def run_encoder(run, job, command):
+  cores = run.core_allocator.acquire(encoder_threads[job['encoder']])
+  if run.args.pin_cores:
+    command = ['taskset', '-c', ','.join(str(core) for core in cores)] + command
   try:
+    start_time = time.time()
     process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    process.stdout.close()
+    rusage = wait_with_rusage(process)
+    return (process.returncode, output, (time.time() - start_time) * 1000, rusage)
+  finally:
+    run.core_allocator.release(cores)
+
+
+def wait_with_rusage(process):
+  """Waits for |process| and returns the resources used by it.
+
+  Unlike getrusage(RUSAGE_CHILDREN) this only covers |process| (and its
+  waited-for children), even with other jobs running concurrently.
+  """
+  (_, status, rusage) = os.wait4(process.pid, 0)
+  if os.WIFSIGNALED(status):
+    process.returncode = -os.WTERMSIG(status)
+  else:
+    process.returncode = os.WEXITSTATUS(status)
+  return rusage
+
+
+def encode_job(run, job, (command, encoded_files)):
+  """Runs the encoder of a job.
+
+  Returns (results with encoder fields filled in for each layer, encoder
+  output), or (None, error) if encoding failed.
+  """
+  clip = job['clip']
+  feeders = [(fifo, start_window_feed(clip, fifo)) for fifo in job.get('input_fifos', [])]
+  try:
+    (returncode, output, actual_encode_ms, encoder_rusage) = run_encoder(run, job, command)
   except OSError as e:
     return (None, "> %s\n%s" % (" ".join(command), e))
-  (output, _) = process.communicate()
-  actual_encode_ms = (time.time() - start_time) * 1000
-  input_yuv_filesize = os.path.getsize(clip['yuv_file'])
-  input_num_frames = int(input_yuv_filesize / (6 * clip['width'] * clip['height'] / 4))
+  finally:
+    for (fifo, feeder) in feeders:
+      finish_window_feed(fifo, feeder)
+  input_num_frames = clip['num_frames']
   target_encode_ms = float(input_num_frames) * 1000 / clip['fps']
-  if process.returncode != 0:
+  if returncode != 0:
     return (None, "> %s\n%s" % (" ".join(command), output))
   results = [{} for i in range(len(encoded_files))]
   for i in range(len(results)):
@@ -472,7 +1259,8 @@ def run_command(job, (command, encoded_files), job_temp_dir, encoded_file_dir):
     results_dict['input-file'] = os.path.basename(clip['input_file'])
     results_dict['input-file-sha1sum'] = clip['sha1sum']
     results_dict['input-total-frames'] = clip['input_total_frames']
-    results_dict['frame-offset'] = args.frame_offset
+    results_dict['frame-offset'] = clip['frame_offset']
+    results_dict['num-frames'] = clip['num_frames']
     results_dict['bitrate-config-kbps'] = job['target_bitrates_kbps']
     results_dict['layer-pattern'] = "%dsl%dtl" % (job['num_spatial_layers'], job['num_temporal_layers'])
     results_dict['encoder'] = job['encoder']
@@ -483,23 +1271,145 @@ def run_command(job, (command, encoded_files), job_temp_dir, encoded_file_dir):
     results_dict['actual-encode-time-ms'] = actual_encode_ms
     results_dict['target-encode-time-ms'] = target_encode_ms
     results_dict['encode-time-utilization'] = actual_encode_ms / target_encode_ms
+    # CPU time is summed over all encoder threads.
+    results_dict['encode-user-time-ms'] = encoder_rusage.ru_utime * 1000
+    results_dict['encode-system-time-ms'] = encoder_rusage.ru_stime * 1000
+    results_dict['encode-cpu-time-ms'] = (encoder_rusage.ru_utime + encoder_rusage.ru_stime) * 1000
+    results_dict['cpu-time-utilization'] = results_dict['encode-cpu-time-ms'] / target_encode_ms
+    # ru_maxrss is in kilobytes on Linux.
+    results_dict['encode-peak-rss-kb'] = encoder_rusage.ru_maxrss
     layer = encoded_files[i]
 
     results_dict['temporal-layer'] = layer['temporal-layer']
     results_dict['spatial-layer'] = layer['spatial-layer']
+    add_bitstream_results(results_dict, layer['filename'])
+  return (results, output)
+
+
+def store_encoded_file(job, encoded_file, encoded_file_dir):
+  clip = job['clip']
+  if encoded_file_dir:
+    clip_name = os.path.splitext(os.path.basename(clip['input_file']))[0]
+    if clip_is_windowed(clip):
+      # Keep files of different windows of the clip apart.
+      clip_name += '@%d+%d' % (clip['frame_offset'], clip['num_frames'])
+    encoded_file_pattern = "%s-%s-%s-%dsl%dtl-%d-sl%d-tl%d%s" % (clip_name, job['encoder'], job['codec'], job['num_spatial_layers'], job['num_temporal_layers'], job['target_bitrates_kbps'][-1], encoded_file['spatial-layer'], encoded_file['temporal-layer'], os.path.splitext(encoded_file['filename'])[1])
+    shutil.move(encoded_file['filename'], os.path.join(encoded_file_dir, encoded_file_pattern))
+  else:
+    os.remove(encoded_file['filename'])
+
+
+def run_command(run, job, (command, encoded_files), job_temp_dir, encoded_file_dir):
+  (results, output) = encode_job(run, job, (command, encoded_files))
+  if results is None:
+    return (None, output)
+  for (results_dict, layer) in zip(results, encoded_files):
+    generate_metrics(run, results_dict, job, job_temp_dir, layer)
+    store_encoded_file(job, layer, encoded_file_dir)
+
+  shutil.rmtree(job_temp_dir)
+
+  return (results, output)
 
-    generate_metrics(results_dict, job, job_temp_dir, layer)
-    if encoded_file_dir:
-      encoded_file_pattern = "%s-%s-%s-%dsl%dtl-%d-sl%d-tl%d%s" % (os.path.splitext(os.path.basename(clip['input_file']))[0], job['encoder'], job['codec'], job['num_spatial_layers'], job['num_temporal_layers'], job['target_bitrates_kbps'][-1], layer['spatial-layer'], layer['temporal-layer'], os.path.splitext(layer['filename'])[1])
-      shutil.move(layer['filename'], os.path.join(encoded_file_dir, encoded_file_pattern))
-    else:
-      os.remove(layer['filename'])
+
+def percentile(values, fraction):
+  """Linearly interpolated percentile of a sorted list."""
+  position = (len(values) - 1) * fraction
+  lower = int(math.floor(position))
+  upper = min(lower + 1, len(values) - 1)
+  return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def median(values):
+  return percentile(sorted(values), 0.5)
+
+
+def benchmark_job(run, job, (command, encoded_files), job_temp_dir, encoded_file_dir):
+  """Times the encoder of a job without computing any metrics.
+
+  The encoder is run --benchmark-warmup times before --benchmark-runs timed
+  runs. Timing fields of the results summarize the timed runs.
+  """
+  clip = job['clip']
+  timed_runs = []
+  for i in range(run.args.benchmark_warmup + run.args.benchmark_runs):
+    # Each run consumes and removes the job's input FIFOs, which would otherwise
+    # be recreated as regular files by the next run's feeders.
+    for fifo in job.get('input_fifos', []):
+      if not os.path.exists(fifo):
+        os.mkfifo(fifo)
+    (results, output) = encode_job(run, job, (command, encoded_files))
+    if results is None:
+      return (None, output)
+    if i >= run.args.benchmark_warmup:
+      timed_runs.append(results[0])
+
+  encode_times = sorted(timed_run['actual-encode-time-ms'] for timed_run in timed_runs)
+  mean_encode_ms = sum(encode_times) / len(encode_times)
+  summary = {
+    'benchmark-runs': run.args.benchmark_runs,
+    'benchmark-warmup-runs': run.args.benchmark_warmup,
+    'benchmark-encode-time-ms': array.array('d', [timed_run['actual-encode-time-ms'] for timed_run in timed_runs]),
+    'actual-encode-time-ms': percentile(encode_times, 0.5),
+    'encode-time-ms-p95': percentile(encode_times, 0.95),
+    'encode-time-ms-stddev': math.sqrt(sum((t - mean_encode_ms) ** 2 for t in encode_times) / max(len(encode_times) - 1, 1)),
+    'encode-peak-rss-kb': max(timed_run['encode-peak-rss-kb'] for timed_run in timed_runs),
+  }
+  for key in ['encode-user-time-ms', 'encode-system-time-ms', 'encode-cpu-time-ms']:
+    summary[key] = median([timed_run[key] for timed_run in timed_runs])
+  summary['encode-time-utilization'] = summary['actual-encode-time-ms'] / timed_runs[0]['target-encode-time-ms']
+  summary['cpu-time-utilization'] = summary['encode-cpu-time-ms'] / timed_runs[0]['target-encode-time-ms']
+  summary['encode-fps'] = clip['num_frames'] * 1000.0 / summary['actual-encode-time-ms']
+
+  for (results_dict, layer) in zip(results, encoded_files):
+    results_dict.update(summary)
+    # Without decoding, layer frames are counted in the encoded file or
+    # estimated from the layer's frame rate.
+    temporal_divide = layer_temporal_divide(job, layer)
+    add_layer_results(results_dict, job, layer, results_dict.get('encoded-frames') or (clip['num_frames'] + temporal_divide - 1) // temporal_divide)
+    store_encoded_file(job, layer, encoded_file_dir)
 
   shutil.rmtree(job_temp_dir)
 
   return (results, output)
 
 
+def job_cache_key(args, job, (command, encoded_files), job_temp_dir):
+  clip = job['clip']
+  # Temporary paths differ between runs, normalize them so that the same job
+  # yields the same key.
+  temp_path_pattern = re.compile(re.escape(job_temp_dir) + r"/[^\s,]*")
+  normalized_command = [os.path.basename(command[0])]
+  for arg in command[1:]:
+    arg = arg.replace(clip['yuv_file'], '$INPUT')
+    normalized_command.append(temp_path_pattern.sub('$TEMP', arg))
+  binaries = [command[0], find_absolute_path(False, decoder_binary(job['codec']))]
+  if args.metrics_engine == 'tiny_ssim':
+    binaries.append(find_absolute_path(False, 'libvpx/tools/tiny_ssim'))
+  if args.enable_vmaf:
+    binaries.append(find_absolute_path(False, 'vmaf/run_vmaf'))
+  key_info = {
+    'input-file': os.path.basename(clip['input_file']),
+    'input-file-sha1sum': clip['sha1sum'],
+    'frame-offset': clip['frame_offset'],
+    'num-frames': clip['num_frames'],
+    'enable-vmaf': args.enable_vmaf,
+    'bitstream-parser': bitstream.VERSION,
+    'metric-sampling': args.metric_sampling,
+    'metrics-engine': args.metrics_engine if args.metrics_engine == 'tiny_ssim' else '%s-%d' % (args.metrics_engine, yuv_metrics.VERSION),
+    'command': normalized_command,
+    'binaries': dict((os.path.basename(binary), binary_sha1sum(binary)) for binary in binaries),
+    'job': {
+      'encoder': job['encoder'],
+      'codec': job['codec'],
+      'target_bitrates_kbps': job['target_bitrates_kbps'],
+      'num_spatial_layers': job['num_spatial_layers'],
+      'num_temporal_layers': job['num_temporal_layers'],
+    },
+  }
+  return (result_cache.key_for(key_info), key_info)
+
+
 def find_bitrates(width, height):
   # Do multiples of 100, because grouping based on bitrate splits in
   # generate_graphs.py doesn't round properly.
@@ -530,26 +1440,129 @@ def split_temporal_bitrates_kbps(target_bitrate_kbps, num_temporal_layers):
   return bitrates_kbps
 
 
-def generate_jobs(args, temp_dir):
+def make_job(args, clip, encoder, codec, bitrate_kbps):
+  return {
+    'encoder': encoder,
+    'codec': codec,
+    'clip': clip,
+    'target_bitrates_kbps': split_temporal_bitrates_kbps(bitrate_kbps, args.num_temporal_layers),
+    'num_spatial_layers': args.num_spatial_layers,
+    'num_temporal_layers': args.num_temporal_layers,
+  }
+
+
+def prepare_job(run, job, job_temp_dir):
+  """Builds the command of a job writing to |job_temp_dir|.
+
+  Returns (job, (command, encoded files), job_temp_dir).
+  """
+  # Input FIFOs are created along with the command.
+  job.pop('input_fifos', None)
+  (command, encoded_files) = encoder_commands[job['encoder']](job, job_temp_dir)
+  command[0] = find_absolute_path(run.args.use_system_path, command[0], run.log)
+  return (job, (command, encoded_files), job_temp_dir)
+
+
+def generate_jobs(run):
+  args = run.args
+  if args.adaptive_ladder:
+    return start_bitrate_searches(run)
   jobs = []
   for clip in args.clips:
     bitrates = find_bitrates(clip['width'], clip['height'])
     for bitrate_kbps in bitrates:
       for (encoder, codec) in args.encoders:
-        job = {
-          'encoder': encoder,
-          'codec': codec,
-          'clip': clip,
-          'target_bitrates_kbps': split_temporal_bitrates_kbps(bitrate_kbps, args.num_temporal_layers),
-          'num_spatial_layers': args.num_spatial_layers,
-          'num_temporal_layers': args.num_temporal_layers,
-        }
-        job_temp_dir = tempfile.mkdtemp(dir=temp_dir)
-        (command, encoded_files) = encoder_commands[job['encoder']](job, job_temp_dir)
-        command[0] = find_absolute_path(args.use_system_path, command[0])
-        jobs.append((job, (command, encoded_files), job_temp_dir))
+        jobs.append(make_job(args, clip, encoder, codec, bitrate_kbps))
   return jobs
 
+
+def bitrate_search_key(clip, encoder, codec):
+  return clip_key(clip) + (encoder, codec)
+
+
+def start_bitrate_searches(run):
+  """Starts a bitrate search per clip and encoder, returns their first jobs.
+
+  Searches start with the lowest, middle and highest bitrates of the fixed
+  ladder and may go up to 4x beyond either end of it.
+  """
+  args = run.args
+  jobs = []
+  for clip in args.clips:
+    ladder = find_bitrates(clip['width'], clip['height'])
+    for (encoder, codec) in args.encoders:
+      search = bitrate_search.BitrateSearch([ladder[0], ladder[len(ladder) // 2], ladder[-1]], ladder[0] / 4.0, ladder[-1] * 4, args.quality_targets, args.quality_tolerance, args.max_encodes)
+      for bitrate_kbps in search.start():
+        jobs.append(make_job(args, clip, encoder, codec, bitrate_kbps))
+      run.bitrate_searches[bitrate_search_key(clip, encoder, codec)] = search
+  return jobs
+
+
+def full_stream_quality(results, metric):
+  # The highest layer holds the quality of the complete stream.
+  return max(results, key=lambda result: (result['spatial-layer'], result['temporal-layer'])).get(metric)
+
+
+def continue_bitrate_search(run, job, results):
+  """Adds jobs for the next bitrates of the finished job's search."""
+  args = run.args
+  with run.lock:
+    search = run.bitrate_searches[bitrate_search_key(job['clip'], job['encoder'], job['codec'])]
+    quality = full_stream_quality(results, args.ladder_metric) if results else None
+    bitrates = search.add_result(job['target_bitrates_kbps'][-1], quality)
+    done = search.is_done()
+  jobs = [make_job(args, job['clip'], job['encoder'], job['codec'], bitrate_kbps) for bitrate_kbps in bitrates]
+  if run.reference_pool:
+    run.reference_pool.add_jobs(jobs)
+  with run.lock:
+    run.total_jobs += len(jobs)
+  run.job_queue.add(jobs)
+  if done:
+    lines = ["Bitrate search done for %s:%s %s (%d encodes)" % (job['encoder'], job['codec'], os.path.basename(job['clip']['input_file']), len(search.points))]
+    lines += ["  %s %s" % (args.ladder_metric, line) for line in search.summary()]
+    run.log("\n".join(lines))
+    run.job_queue.remove_producer()
+
+def load_cost_history(history_files):
+  """Collects encode times from previous results to estimate job costs.
+
+  Returns (encode times of previously-run jobs, encode time per pixel and frame
+  for each encoder).
+  """
+  job_times = {}
+  encoder_totals = {}
+  for f in history_files:
+    for result in results_file.read_results(f):
+      # Results of temporal layers share an encode, only count them once.
+      if result['temporal-layer'] != 0:
+        continue
+      num_frames = results_file.result_num_frames(result)
+      key = (result['input-file-sha1sum'], result['frame-offset'], num_frames, result['encoder'], result['codec'], tuple(result['bitrate-config-kbps']))
+      job_times[key] = result['actual-encode-time-ms']
+      (total_ms, total_pixels) = encoder_totals.get(result['encoder'], (0.0, 0))
+      encoder_totals[result['encoder']] = (total_ms + result['actual-encode-time-ms'], total_pixels + result['width'] * result['height'] * num_frames)
+  encoder_ms_per_pixel = dict((encoder, total_ms / total_pixels) for (encoder, (total_ms, total_pixels)) in encoder_totals.iteritems() if total_pixels > 0)
+  return (job_times, encoder_ms_per_pixel)
+
+
+def estimate_job_cost(job, (job_times, encoder_ms_per_pixel)):
+  """Estimated core-milliseconds spent encoding |job|."""
+  clip = job['clip']
+  key = (clip['sha1sum'], clip['frame_offset'], clip['num_frames'], job['encoder'], job['codec'], tuple(job['target_bitrates_kbps']))
+  if key in job_times:
+    encode_ms = job_times[key]
+  else:
+    ms_per_pixel = encoder_ms_per_pixel.get(job['encoder'], default_encode_ms_per_pixel[job['encoder']])
+    encode_ms = ms_per_pixel * clip['width'] * clip['height'] * clip['num_frames']
+  return encode_ms * encoder_threads[job['encoder']]
+
+
+def schedule_jobs(jobs, history):
+  # Jobs are taken from the back of the queue, so this runs the longest jobs
+  # first to avoid ending the run on a single long job.
+  return sorted(jobs, key=lambda job: estimate_job_cost(job, history))
+
+
 def start_daemon(func):
   t = threading.Thread(target=func)
   t.daemon = True
@@ -559,87 +1572,621 @@ def start_daemon(func):
 def job_to_string(job):
     return "%s:%s %dsl%dtl %s %s" % (job['encoder'], job['codec'], job['num_spatial_layers'], job['num_temporal_layers'], ":".join(str(i) for i in job['target_bitrates_kbps']), os.path.basename(job['clip']['input_file']))
 
-def worker():
-  global args
-  global jobs
-  global current_job
-  global has_errored
-  global total_jobs
-  pp = pprint.PrettyPrinter(indent=2)
+class JobQueue(object):
+  """Jobs waiting to run and jobs leased to local or remote workers.
+
+  Leases given out with a timeout expire unless renewed, after which the job
+  is handed out again. A job is finished by the first result reported for it.
+  """
+
+  def __init__(self, jobs, producers=0):
+    self.condition = threading.Condition()
+    self.jobs = dict(enumerate(jobs))
+    self.pending = range(len(jobs))
+    self.leases = {}
+    self.next_job_id = len(jobs)
+    # Producers may still add jobs, the queue isn't done until they're removed.
+    self.producers = producers
+
+  def add(self, jobs):
+    with self.condition:
+      for job in jobs:
+        self.jobs[self.next_job_id] = job
+        self.pending.append(self.next_job_id)
+        self.next_job_id += 1
+      self.condition.notify_all()
+
+  def remove_producer(self):
+    with self.condition:
+      self.producers -= 1
+      self.condition.notify_all()
+
+  def lease(self, block=True, timeout=None):
+    """Returns (job_id, job) or None if no job is currently available.
+
+    Blocking leases only return None when all jobs are finished.
+    """
+    with self.condition:
+      while not self.pending:
+        if (not self.jobs and not self.producers) or not block:
+          return None
+        self.condition.wait(1)
+      job_id = self.pending.pop()
+      self.leases[job_id] = time.time() + timeout if timeout else None
+      return (job_id, self.jobs[job_id])
+
+  def renew(self, job_id, timeout):
+    with self.condition:
+      if job_id in self.leases:
+        self.leases[job_id] = time.time() + timeout
+
+  def release(self, job_ids):
+    """Puts leased jobs back in the queue to be handed out again."""
+    with self.condition:
+      for job_id in job_ids:
+        if job_id in self.leases:
+          del self.leases[job_id]
+          self.pending.append(job_id)
+      self.condition.notify_all()
+
+  def expire_leases(self):
+    with self.condition:
+      now = time.time()
+      expired = [job_id for (job_id, deadline) in self.leases.iteritems() if deadline is not None and deadline < now]
+    self.release(expired)
+    return expired
+
+  def get(self, job_id):
+    with self.condition:
+      return self.jobs.get(job_id)
+
+  def finish(self, job_id):
+    """Returns False if the job was already finished."""
+    with self.condition:
+      if job_id not in self.jobs:
+        return False
+      del self.jobs[job_id]
+      self.leases.pop(job_id, None)
+      if job_id in self.pending:
+        self.pending.remove(job_id)
+      self.condition.notify_all()
+      return True
+
+  def is_done(self):
+    with self.condition:
+      return not self.jobs and not self.producers
+
+  def wait_until_done(self):
+    with self.condition:
+      while self.jobs or self.producers:
+        self.condition.wait(1)
+
+  def close(self):
+    """Drops all jobs, leases and producers, so that the queue is done."""
+    with self.condition:
+      self.jobs.clear()
+      self.pending = []
+      self.leases.clear()
+      self.producers = 0
+      self.condition.notify_all()
+
+
+class JobRun(object):
+  """State of one run of jobs, shared by its workers and stages.
+
+  Progress and warnings are passed to |log|, or dropped if it's None.
+  """
+
+  def __init__(self, args, log=None):
+    self.args = args
+    self.log_function = log
+    self.core_allocator = CoreAllocator(multiprocessing.cpu_count())
+    self.storage = None
+    self.cache = None
+    self.reference_pool = None
+    self.job_queue = None
+    self.decode_stage = None
+    self.metrics_stage = None
+    # Guards bitrate searches and the job count, which grows as they go.
+    self.lock = threading.Lock()
+    self.bitrate_searches = {}
+    self.total_jobs = 0
+    self.finished_jobs = Queue.Queue()
+    self.stopped = threading.Event()
+
+  def log(self, message):
+    if self.log_function:
+      self.log_function(message)
+
+  def stop(self):
+    """Drops jobs that haven't started, jobs in progress still finish."""
+    self.stopped.set()
+    if self.job_queue:
+      self.job_queue.close()
+
+
+def report_result(run, job, results, error, cached=False):
+  run.finished_jobs.put((job, results, error, cached))
+
+
+def finish_job(run, job_id, (job, command, job_temp_dir), results, error):
+  if job_temp_dir:
+    run.storage.release(job_temp_dir)
+  if not run.job_queue.finish(job_id):
+    # Another worker already finished this job after its lease expired, or
+    # the run was stopped.
+    return
+  if run.cache and results is not None:
+    run.cache.put(job['cache_key'][0], job['cache_key'][1], results)
+  report_result(run, job, results, error)
+  job_finished(run, job, results)
+
+
+def job_finished(run, job, results):
+  # Continue searches first so that the clip's reference stays in the pool if
+  # more jobs are added for it.
+  if run.bitrate_searches:
+    continue_bitrate_search(run, job, results)
+  if run.reference_pool:
+    run.reference_pool.release(job['clip'])
+
+
+def lease_job(run, block=True, timeout=None, local=True):
+  """Leases the next job that needs to run, finishing cached jobs directly.
+
+  Returns (job id, (job, command, job temp dir)). Jobs to run locally wait for
+  temp storage, jobs for remote workers have no command or temp dir. Jobs
+  that can't be prepared are finished with an error.
+  """
   while True:
-    with thread_lock:
-      if not jobs:
+    leased_job = run.job_queue.lease(block, timeout)
+    if leased_job is None:
+      return None
+    (job_id, job) = leased_job
+    job_temp_dir = None
+    try:
+      if run.cache:
+        # Commands contain temp paths, which the cache key doesn't depend on.
+        scratch_dir = tempfile.mkdtemp(dir=run.storage.disk_dir)
+        try:
+          (_, command, _) = prepare_job(run, job, scratch_dir)
+          job['cache_key'] = job_cache_key(run.args, job, command, scratch_dir)
+        finally:
+          shutil.rmtree(scratch_dir)
+        # Encoded files are not cached, so jobs need to run to produce them.
+        results = run.cache.get(job['cache_key'][0]) if not run.args.encoded_file_dir else None
+        if results is not None:
+          if run.job_queue.finish(job_id):
+            report_result(run, job, results, None, cached=True)
+            job_finished(run, job, results)
+          continue
+      if not local:
+        return (job_id, (job, None, None))
+      job_temp_dir = run.storage.acquire(estimate_job_footprint(run, job))
+      if run.stopped.is_set():
+        # The run was stopped while waiting for temp storage.
+        run.storage.release(job_temp_dir)
+        return None
+      return (job_id, prepare_job(run, job, job_temp_dir))
+    except Exception:
+      # Make sure failing jobs are finished, or the run would never end.
+      finish_job(run, job_id, (job, None, job_temp_dir), None, traceback.format_exc())
+
+
+def worker(run):
+  while True:
+    leased_job = lease_job(run)
+    if leased_job is None:
+      return
+    (job_id, (job, command, job_temp_dir)) = leased_job
+    try:
+      (results, error) = run_command(run, job, command, job_temp_dir, run.args.encoded_file_dir)
+    except Exception:
+      # Make sure failing jobs are finished, or the run would never end.
+      (results, error) = (None, traceback.format_exc())
+    finish_job(run, job_id, (job, command, job_temp_dir), results, error)
+
+
+class Stage(object):
+  """A pool of threads running tasks of one pipeline stage.
+
+  Tasks wait in a bounded queue, so submitting to a stage that is behind
+  blocks the previous stage instead of piling up work (and temporary files).
+  Stages without threads run tasks directly in the submitting thread.
+  """
+
+  def __init__(self, num_workers):
+    self.queue = Queue.Queue(maxsize=num_workers)
+    self.threads = [start_daemon(self.run) for i in range(num_workers)]
+
+  def submit(self, task):
+    if self.threads:
+      self.queue.put(task)
+    else:
+      task()
+
+  def run(self):
+    while True:
+      task = self.queue.get()
+      if task is None:
         return
-      (job, command, job_temp_dir) = jobs.pop()
+      task()
+
+  def close(self):
+    """Runs the tasks submitted so far and stops the threads."""
+    for thread in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+
+
+class PipelinedJob(object):
+  """A job whose layers are decoded and scored by separate stages.
+
+  Counts outstanding tasks and finishes the job once the last one is done.
+  """
+
+  def __init__(self, run, job_id, entry, results, output):
+    self.job_run = run
+    self.job_id = job_id
+    self.entry = entry
+    self.results = results
+    self.output = output
+    self.layer_frames = [None] * len(results)
+    self.lock = threading.Lock()
+    self.pending_tasks = 0
+    self.error = None
+
+  def submit(self, stage, task):
+    with self.lock:
+      self.pending_tasks += 1
+    stage.submit(lambda: self.run(task))
+
+  def run(self, task):
+    try:
+      task()
+      self.task_done(None)
+    except Exception:
+      self.task_done(traceback.format_exc())
+
+  def task_done(self, error):
+    with self.lock:
+      self.pending_tasks -= 1
+      if error and not self.error:
+        self.error = error
+      if self.pending_tasks > 0:
+        return
+    self.finish()
+
+  def finish(self):
+    (job, (command, encoded_files), job_temp_dir) = self.entry
+    error = self.error
+    try:
+      if not error:
+        for (i, (results_dict, layer)) in enumerate(zip(self.results, encoded_files)):
+          add_layer_results(results_dict, job, layer, self.layer_frames[i])
+          store_encoded_file(job, layer, self.job_run.args.encoded_file_dir)
+    except Exception:
+      error = traceback.format_exc()
+    shutil.rmtree(job_temp_dir, ignore_errors=True)
+    finish_job(self.job_run, self.job_id, self.entry, self.results if not error else None, error if error else self.output)
+
+
+def decode_task(pipelined_job, i):
+  run = pipelined_job.job_run
+  (job, (command, encoded_files), job_temp_dir) = pipelined_job.entry
+  (results_dict, layer) = (pipelined_job.results[i], encoded_files[i])
+  if run.args.stream_decode:
+    # Streaming decodes compute metrics concurrently already.
+    pipelined_job.layer_frames[i] = stream_metrics(run, results_dict, job, job_temp_dir, layer, layer_temporal_divide(job, layer) - 1)
+    return
+  decoded_file = decode_layer(results_dict, job, job_temp_dir, layer)
+  if run.args.metric_sampling:
+    def sampled_task():
+      pipelined_job.layer_frames[i] = sampled_metrics(run, results_dict, job, job_temp_dir, layer, decoded_file)
+    pipelined_job.submit(run.metrics_stage, sampled_task)
+    return
+  def ssim_task():
+    pipelined_job.layer_frames[i] = ssim_metrics(run, results_dict, job, job_temp_dir, layer, decoded_file)
+  pipelined_job.submit(run.metrics_stage, ssim_task)
+  if run.args.enable_vmaf:
+    pipelined_job.submit(run.metrics_stage, lambda: vmaf_metrics(run, results_dict, job, job_temp_dir, decoded_file))
+
+
+def pipelined_worker(run):
+  """Encodes jobs and hands their layers over to the decode stage."""
+  while True:
+    leased_job = lease_job(run)
+    if leased_job is None:
+      return
+    (job_id, entry) = leased_job
+    (job, command, job_temp_dir) = entry
+    try:
+      (results, output) = encode_job(run, job, command)
+    except Exception:
+      (results, output) = (None, traceback.format_exc())
+    if results is None:
+      shutil.rmtree(job_temp_dir, ignore_errors=True)
+      finish_job(run, job_id, entry, None, output)
+      continue
+    pipelined_job = PipelinedJob(run, job_id, entry, results, output)
+    # Hold a task until all layers are submitted so the job can't finish early.
+    with pipelined_job.lock:
+      pipelined_job.pending_tasks += 1
+    for i in range(len(results)):
+      pipelined_job.submit(run.decode_stage, lambda pipelined_job=pipelined_job, i=i: decode_task(pipelined_job, i))
+    pipelined_job.task_done(None)
+
+
+# Job fields sent to remote workers, which build commands themselves.
+remote_job_keys = ['encoder', 'codec', 'clip', 'target_bitrates_kbps', 'num_spatial_layers', 'num_temporal_layers']
+
+def remote_options(args):
+  return {
+    'enable_vmaf': args.enable_vmaf,
+    'lease_timeout': args.lease_timeout,
+    'metric_sampling': args.metric_sampling,
+    'metrics_engine': args.metrics_engine,
+    'stream_decode': args.stream_decode,
+  }
 
-    (results, error) = run_command(job, command, job_temp_dir, args.encoded_file_dir)
 
-    job_str = job_to_string(job)
-
-    with thread_lock:
-      current_job += 1
-      run_ok = results is not None
-      print "[%d/%d] %s (%s)" % (current_job, total_jobs, job_str, "OK" if run_ok else "ERROR")
-      if not run_ok:
-        has_errored = True
-        print error
-      else:
-        for result in results:
-          args.out.write(pp.pformat(result))
-          args.out.write(',\n')
-        args.out.flush()
+class CoordinatorHandler(SocketServer.StreamRequestHandler):
+  """Serves jobs to a remote worker over newline-delimited JSON messages.
+
+  The worker sends 'lease' requests which are answered with a 'job', or with
+  'wait' or 'done' when no job is available. Leases are kept alive with
+  'renew' messages and finished with a 'result' message. Jobs leased over a
+  connection that goes away are re-queued.
+  """
+
+  def send(self, message):
+    self.wfile.write(results_file.dumps(message) + '\n')
+    self.wfile.flush()
+
+  def handle(self):
+    run = self.server.job_run
+    leased = set()
+    try:
+      self.send({'type': 'options', 'options': remote_options(run.args)})
+      for line in iter(self.rfile.readline, ''):
+        message = json.loads(line)
+        if message['type'] == 'lease':
+          leased_job = lease_job(run, block=False, timeout=run.args.lease_timeout, local=False)
+          if leased_job is None:
+            self.send({'type': 'done' if run.job_queue.is_done() else 'wait'})
+            continue
+          (job_id, (job, command, job_temp_dir)) = leased_job
+          leased.add(job_id)
+          self.send({'type': 'job', 'id': job_id, 'job': dict((key, job[key]) for key in remote_job_keys)})
+        elif message['type'] == 'renew':
+          run.job_queue.renew(message['id'], run.args.lease_timeout)
+        elif message['type'] == 'result':
+          job_id = message['id']
+          leased.discard(job_id)
+          job = run.job_queue.get(job_id)
+          if job is None:
+            continue
+          results = results_file.byteify(message['results'])
+          finish_job(run, job_id, (job, None, None), results, message['output'])
+    finally:
+      run.job_queue.release(leased)
+
+
+class CoordinatorServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, address, run):
+    SocketServer.TCPServer.__init__(self, address, CoordinatorHandler)
+    self.job_run = run
+
+
+def lease_reaper(run):
+  while not run.job_queue.is_done():
+    time.sleep(1)
+    for job_id in run.job_queue.expire_leases():
+      job = run.job_queue.get(job_id)
+      if job is None:
+        continue
+      run.log("WARNING: Lease expired, re-queueing %s" % job_to_string(job))
 
 
 thread_lock = threading.Lock()
 
-def main():
-  global args
-  global jobs
-  global total_jobs
-  global current_job
-  global has_errored
+def print_message(message):
+  with thread_lock:
+    print message
 
-  temp_dir = tempfile.mkdtemp()
 
-  args = parser.parse_args()
-  prepare_clips(args, temp_dir)
-  jobs = generate_jobs(args, temp_dir)
-  total_jobs = len(jobs)
-  current_job = 0
-  has_errored = False
+def dump_commands(args):
+  run = JobRun(args, log=print_message)
+  prepare_clips(run)
+  jobs = generate_jobs(run)
+  temp_dir = tempfile.mkdtemp()
+  for (current_job, job) in enumerate(schedule_jobs(jobs, load_cost_history(args.cost_history)), 1):
+    (job, (command, encoded_files), job_temp_dir) = prepare_job(run, job, tempfile.mkdtemp(dir=temp_dir))
+    print "[%d/%d] %s" % (current_job, len(jobs), job_to_string(job))
+    print "> %s" % " ".join(command)
+    print
+  shutil.rmtree(temp_dir)
 
-  if args.dump_commands:
-    for (job, (command, encoded_files), job_temp_dir) in jobs:
-      current_job += 1
-      print "[%d/%d] %s" % (current_job, total_jobs, job_to_string(job))
-      print "> %s" % " ".join(command)
-      print
 
-    shutil.rmtree(temp_dir)
-    return 0
+def check_args(args):
+  """Raises SetupError if |args| can't be run."""
+  if args.workers <= 0 and not args.serve:
+    raise SetupError("--workers=0 requires --serve, or no jobs can run.")
+  if args.serve and args.cache_dir:
+    # Cache keys hash the binaries that produce results, which remote workers
+    # build and run themselves.
+    raise SetupError("--serve can't be combined with --cache-dir, as results of remote workers don't come from this host's binaries.")
+  if args.benchmark:
+    for (option, value) in [('adaptive-ladder', args.adaptive_ladder), ('cache-dir', args.cache_dir), ('serve', args.serve)]:
+      if value:
+        raise SetupError("--benchmark can't be combined with --%s." % option)
+    # Benchmarked encoders are always pinned.
+    args.pin_cores = True
+
+  if args.pin_cores and not find_executable('taskset'):
+    raise SetupError("--pin-cores requires 'taskset' to be in PATH.")
+  if args.benchmark:
+    # No decoding or metrics are done.
+    return
 
   # Make sure commands for quality metrics are present.
-  find_absolute_path(False, 'libvpx/tools/tiny_ssim')
+  if args.metrics_engine == 'numpy':
+    if not yuv_metrics:
+      raise SetupError("--metrics-engine=numpy requires NumPy to be installed.")
+  else:
+    find_absolute_path(False, 'libvpx/tools/tiny_ssim')
   for (encoder, codec) in args.encoders:
-    if codec in ['vp8', 'vp9']:
-      find_absolute_path(False, 'libvpx/vpxdec')
-    elif codec == 'av1':
-      find_absolute_path(False, 'aom/aomdec')
-    elif codec == 'h264':
-      find_absolute_path(False, 'openh264/h264dec')
+    find_absolute_path(False, decoder_binary(codec))
   if args.enable_vmaf:
     find_absolute_path(False, 'vmaf/run_vmaf')
 
-  print "[0/%d] Running jobs..." % total_jobs
+  if args.metric_sampling and args.stream_decode:
+    raise SetupError("--metric-sampling can't be combined with --stream-decode.")
+  if args.metric_sampling and not yuv_metrics:
+    raise SetupError("--metric-sampling requires NumPy to be installed.")
+
+  if args.adaptive_ladder and args.ladder_metric == 'vmaf' and not args.enable_vmaf:
+    raise SetupError("--ladder-metric=vmaf requires --enable-vmaf.")
+
+
+def run_benchmarks(run, jobs):
+  # Jobs run one at a time so that encoders don't compete for cores, caches
+  # or memory bandwidth.
+  for job in jobs:
+    if run.stopped.is_set():
+      return
+    job_temp_dir = run.storage.acquire(estimate_job_footprint(run, job))
+    try:
+      (job, command, job_temp_dir) = prepare_job(run, job, job_temp_dir)
+      (results, error) = benchmark_job(run, job, command, job_temp_dir, run.args.encoded_file_dir)
+    except Exception:
+      (results, error) = (None, traceback.format_exc())
+    run.storage.release(job_temp_dir)
+    report_result(run, job, results, error)
+
+
+def run_workers(run):
+  args = run.args
+  server = None
+  if args.serve:
+    server = CoordinatorServer(args.serve, run)
+    start_daemon(server.serve_forever)
+    start_daemon(lambda: lease_reaper(run))
+    run.log("Serving jobs to remote workers on %s:%d" % server.server_address)
+
+  stages = []
+  if args.decode_workers or args.metrics_workers:
+    run.decode_stage = Stage(args.decode_workers)
+    run.metrics_stage = Stage(args.metrics_workers)
+    # Decode tasks submit to the metrics stage, so stages stop in this order.
+    stages = [run.decode_stage, run.metrics_stage]
+    workers = [start_daemon(lambda: pipelined_worker(run)) for i in range(args.workers)]
+  else:
+    workers = [start_daemon(lambda: worker(run)) for i in range(args.workers)]
+  try:
+    run.job_queue.wait_until_done()
+    [t.join() for t in workers]
+    [stage.close() for stage in stages]
+  finally:
+    if server:
+      server.shutdown()
+      server.server_close()
+
+
+def run_jobs(run):
+  """Runs the jobs described by |run|.args and yields them as they finish.
+
+  |run| is a JobRun of parsed command-line arguments (see parser and
+  check_args()), --out is left for the caller to write to. Yields (job,
+  results, error, cached) where results is a list of result dicts, one for
+  each layer, or None if the job failed with |error|. If the caller stops
+  iterating early, jobs that haven't started are dropped and the run is
+  cleaned up once jobs in progress are done.
+  """
+  args = run.args
+  prepare_clips(run)
+  jobs = schedule_jobs(generate_jobs(run), load_cost_history(args.cost_history))
+  run.total_jobs = len(jobs)
 
-  args.out.write('[')
+  temp_dir = tempfile.mkdtemp()
+  memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget is not None else free_space(memory_temp_dir) if args.benchmark else 0
+  disk_budget = args.disk_budget * 1024 * 1024 if args.disk_budget is not None else free_space(temp_dir)
+  run.storage = StorageManager(temp_dir, disk_budget, memory_temp_dir, memory_budget)
+  if args.cache_dir:
+    run.cache = result_cache.ResultCache(args.cache_dir, args.cache_max_size * 1024 * 1024)
+  if args.reference_pool:
+    run.reference_pool = ReferencePool(run.storage, jobs)
+  run.job_queue = JobQueue(jobs, producers=len(run.bitrate_searches))
+
+  run.log("[0/%d] %s jobs..." % (run.total_jobs, "Benchmarking" if args.benchmark else "Running"))
+
+  failures = []
+  def run_in_background():
+    try:
+      if args.benchmark:
+        run_benchmarks(run, jobs)
+      else:
+        run_workers(run)
+    except Exception:
+      failures.append(sys.exc_info())
+    finally:
+      if run.reference_pool:
+        run.reference_pool.close()
+      run.storage.close()
+      shutil.rmtree(temp_dir, ignore_errors=True)
+      # Jobs are all reported by now.
+      run.finished_jobs.put(None)
+  thread = start_daemon(run_in_background)
 
-  workers = [start_daemon(worker) for i in range(args.workers)]
-  [t.join() for t in workers]
+  try:
+    while True:
+      try:
+        # Wait with a timeout so that KeyboardInterrupt gets through.
+        finished_job = run.finished_jobs.get(timeout=1)
+      except Queue.Empty:
+        continue
+      if finished_job is None:
+        break
+      yield finished_job
+  finally:
+    # Also stops runs that the caller abandoned, so that their workers don't
+    # keep running.
+    run.stop()
+    while thread.is_alive():
+      thread.join(1)
+  if failures:
+    raise failures[0][0], failures[0][1], failures[0][2]
 
-  args.out.write(']\n')
 
-  shutil.rmtree(temp_dir)
+def main():
+  args = parser.parse_args()
+  try:
+    if args.dump_commands:
+      dump_commands(args)
+      return 0
+    check_args(args)
+  except SetupError as e:
+    sys.exit("ERROR: %s" % e)
+
+  run = JobRun(args, log=print_message)
+  has_errored = False
+  try:
+    for (current_job, (job, results, error, cached)) in enumerate(run_jobs(run), 1):
+      with thread_lock:
+        print "[%d/%d] %s (%s)" % (current_job, run.total_jobs, job_to_string(job), "CACHED" if cached else "OK" if results is not None else "ERROR")
+      if results is None:
+        has_errored = True
+        print error
+      else:
+        for result in results:
+          results_file.write_result(args.out, result)
+  except SetupError as e:
+    # Clips are only checked once the run starts.
+    sys.exit("ERROR: %s" % e)
   return 1 if has_errored else 0
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs jobs served by `generate_data.py --serve` on another host. Clips need to
+# be available under the same paths as on the serving host (e.g. on a shared
+# filesystem).
+
+import argparse
+import json
+import multiprocessing
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import generate_data
+import results_file
+
+parser = argparse.ArgumentParser(description='Run generate_data.py jobs served by a remote coordinator.')
+parser.add_argument('coordinator', metavar='HOST:PORT', type=generate_data.server_address)
+parser.add_argument('--encoded-file-dir', default=None, type=generate_data.writable_dir)
+parser.add_argument('--pin-cores', action='store_true')
+parser.add_argument('--use-system-path', action='store_true')
+parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+
+
+class Connection(object):
+  def __init__(self, address):
+    self.socket = socket.create_connection(address)
+    self.rfile = self.socket.makefile('rb')
+    self.send_lock = threading.Lock()
+
+  def send(self, message):
+    with self.send_lock:
+      self.socket.sendall(results_file.dumps(message) + '\n')
+
+  def receive(self):
+    line = self.rfile.readline()
+    if not line:
+      return None
+    return results_file.byteify(json.loads(line))
+
+
+def send_renewals(connection, job_id, interval, stop):
+  while not stop.wait(interval):
+    connection.send({'type': 'renew', 'id': job_id})
+
+
+def run_job(run, job, temp_dir, encoded_file_dir):
+  try:
+    (job, command, temp_dir) = generate_data.prepare_job(run, job, temp_dir)
+    return generate_data.run_command(run, job, command, temp_dir, encoded_file_dir)
+  except Exception:
+    return (None, traceback.format_exc())
+
+
+def worker(run, lease_timeout):
+  connection = Connection(args.coordinator)
+  if connection.receive() is None:
+    return
+  while True:
+    connection.send({'type': 'lease'})
+    message = connection.receive()
+    if message is None or message['type'] == 'done':
+      return
+    if message['type'] == 'wait':
+      time.sleep(1)
+      continue
+
+    job = message['job']
+    temp_dir = tempfile.mkdtemp()
+    stop = threading.Event()
+    generate_data.start_daemon(lambda job_id=message['id'], stop=stop: send_renewals(connection, job_id, lease_timeout / 4.0, stop))
+    (results, output) = run_job(run, job, temp_dir, args.encoded_file_dir)
+    stop.set()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    print "%s (%s)" % (generate_data.job_to_string(job), "OK" if results is not None else "ERROR")
+    connection.send({'type': 'result', 'id': message['id'], 'results': results, 'output': output})
+
+
+def main():
+  global args
+  args = parser.parse_args()
+
+  # Options that affect results are decided by the coordinator.
+  connection = Connection(args.coordinator)
+  options = connection.receive()['options']
+  connection.socket.close()
+  run = generate_data.JobRun(argparse.Namespace(encoded_file_dir=args.encoded_file_dir, use_system_path=args.use_system_path, pin_cores=args.pin_cores, **options), log=generate_data.print_message)
+  if options['metrics_engine'] == 'numpy' and not generate_data.yuv_metrics:
+    sys.exit("ERROR: --metrics-engine=numpy requires NumPy to be installed.")
+  if options['metric_sampling'] and not generate_data.yuv_metrics:
+    sys.exit("ERROR: --metric-sampling requires NumPy to be installed.")
+
+  workers = [generate_data.start_daemon(lambda: worker(run, options['lease_timeout'])) for i in range(args.workers)]
+  while any(t.is_alive() for t in workers):
+    time.sleep(1)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
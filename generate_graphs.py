@@ -14,10 +14,28 @@
 # limitations under the License.
 
 import argparse
-import ast
+import base64
+import errno
+import hashlib
+import json
+import math
+import matplotlib
+# Render without a display, also in worker processes.
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import multiprocessing
 import os
 import re
+import zlib
+
+import results_file
+
+# Bump when changing how graphs are drawn, so that existing graphs are redrawn.
+GRAPH_STYLE_VERSION = 2
+MANIFEST_FILE = '.graph-manifest.json'
+IMAGE_FORMATS = ['png', 'svg']
+REPORT_FILE = 'report.html'
+REPORT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report_template.html')
 
 layer_regex_pattern = re.compile(r"^(\d)sl(\d)tl$")
 def writable_dir(directory):
@@ -28,7 +46,7 @@ def writable_dir(directory):
 def formats(formats_list):
   formats = formats_list.split(',')
   for extension in formats:
-    if extension not in ['png', 'svg']:
+    if extension not in IMAGE_FORMATS + ['html']:
       raise argparse.ArgumentTypeError("'%s' is not a valid file format.\n" % extension)
   return formats
 
@@ -36,85 +54,343 @@ def formats(formats_list):
 parser = argparse.ArgumentParser(description='Generate graphs from data files.')
 parser.add_argument('graph_files', nargs='+', metavar='graph_file.txt', type=argparse.FileType('r'))
 parser.add_argument('--out-dir', required=True, type=writable_dir)
-parser.add_argument('--formats', type=formats, metavar='png,svg', help='comma-separated list of output formats', default=['png', 'svg'])
+parser.add_argument('--force', action='store_true', help='render all graphs, including unchanged ones')
+parser.add_argument('--formats', type=formats, metavar='png,svg,html', help='comma-separated list of output formats, html writes a single report of all graphs', default=['png', 'svg'])
+parser.add_argument('--max-frame-points', type=int, default=2000, metavar='POINTS', help='downsample lines of frame graphs to at most this many points, keeping spikes (0 plots every frame)')
+parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='number of graphs to render in parallel')
 
-def split_data(graph_data, attribute):
-  groups = {}
-  for element in graph_data:
-    value = element[attribute]
-    if value not in groups:
-      groups[value] = []
-    groups[value].append(element)
-  return groups.values()
+metrics = [
+  'vpx-ssim',
+  'ssim',
+  'ssim-y',
+  'ssim-u',
+  'ssim-v',
+  'avg-psnr',
+  'avg-psnr-y',
+  'avg-psnr-u',
+  'avg-psnr-v',
+  'glb-psnr',
+  'glb-psnr-y',
+  'glb-psnr-u',
+  'glb-psnr-v',
+  'encode-time-utilization',
+  'cpu-time-utilization',
+  'encode-peak-rss-kb',
+  'encode-fps',
+  'vmaf'
+]
+
+frame_metrics = [
+  'frame-ssim',
+  'frame-ssim-y',
+  'frame-ssim-u',
+  'frame-ssim-v',
+  'frame-psnr',
+  'frame-psnr-y',
+  'frame-psnr-u',
+  'frame-psnr-v',
+  'frame-qp',
+  'frame-bytes',
+  'frame-vmaf'
+]
 
 def normalize_bitrate_config_string(config):
   return ":".join([str(int(x * 100.0 / config[-1])) for x in config])
 
 
-def generate_graphs(output_dict, graph_data, target_metric, bitrate_config_string):
+def index_results(graph_data):
+  """Groups results by graph and line in a single pass.
+
+  Returns {(input-file, layer-pattern, bitrate config): {(encoder, codec,
+  temporal-layer): [results in file order]}}, where input-file includes the
+  frame window (see results_file.clip_name()).
+  """
+  index = {}
+  for data in graph_data:
+    graph_key = (results_file.clip_name(data), data['layer-pattern'], normalize_bitrate_config_string(data['bitrate-config-kbps']))
+    line_key = (data['encoder'], data['codec'], data['temporal-layer'])
+    index.setdefault(graph_key, {}).setdefault(line_key, []).append(data)
+  return index
+
+
+def generate_graphs(output_dict, (input_file, layer_pattern, bitrate_config_string), graph_lines, target_metric):
   lines = {}
-  for encoder in split_data(graph_data, 'encoder'):
-    for codec in split_data(encoder, 'codec'):
-      for layer in split_data(codec, 'temporal-layer'):
-        metric_data = []
-        for data in layer:
-          if target_metric not in data:
-            return
-          metric_data.append((data['target-bitrate-bps']/1000, data[target_metric], data['bitrate-utilization']))
-        line_name = '%s:%s (tl%d)' % (layer[0]['encoder'], layer[0]['codec'], layer[0]['temporal-layer'])
-        # Sort points on target bitrate.
-        lines[line_name] = sorted(metric_data, key=lambda point: point[0])
-
-  graph_name = "%s-%s-%s:%s" % (graph_data[0]['input-file'], graph_data[0]['layer-pattern'], bitrate_config_string, target_metric)
+  for ((encoder, codec, temporal_layer), layer) in graph_lines.iteritems():
+    metric_data = []
+    for data in layer:
+      if target_metric not in data:
+        return
+      # Metrics computed on sampled frames come with confidence intervals.
+      metric_data.append((data['target-bitrate-bps']/1000, data[target_metric], data['bitrate-utilization'], data.get('%s-ci' % target_metric)))
+    line_name = '%s:%s (tl%d)' % (encoder, codec, temporal_layer)
+    # Sort points on target bitrate.
+    lines[line_name] = sorted(metric_data, key=lambda point: point[0])
+
+  graph_name = "%s-%s-%s:%s" % (input_file, layer_pattern, bitrate_config_string, target_metric)
   output_dict[('', graph_name)] = lines
 
-def main():
-  args = parser.parse_args()
-  graph_data = []
-  for f in args.graph_files:
-    graph_data += ast.literal_eval(f.read())
+def make_dirs(directory):
+  # Several processes may create the same directory concurrently.
+  try:
+    os.makedirs(directory)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+def frame_line_points(line):
+  values = results_file.decode_series(line['values'])
+  frame_bytes = results_file.decode_series(line['frame-bytes']) if line['frame-bytes'] is not None else None
+  # Series of sampled metrics only hold values of the frames listed here.
+  frames = results_file.decode_series(line['frames']) if line['frames'] is not None else range(len(values))
+  points = []
+  for idx, val in zip(frames, values):
+    frame_size = frame_bytes[idx] if frame_bytes is not None and idx < len(frame_bytes) else -1
+    points.append((line['first-frame'] + line['frame-step'] * idx, val, frame_size, None))
+  return points
+
+def downsample_points(points, max_points):
+  """Reduces a line of frame points to at most |max_points| points.
+
+  Frames are split into equal buckets and each bucket keeps the frames with
+  the lowest and highest value and frame size, in frame order. Spikes such as
+  key frames and quality drops survive, which averaging would smooth out.
+  """
+  if max_points <= 0 or len(points) <= max_points:
+    return points
+  num_buckets = max(max_points // 4, 1)
+  kept = []
+  for bucket in range(num_buckets):
+    indices = range(len(points) * bucket // num_buckets, len(points) * (bucket + 1) // num_buckets)
+    if not indices:
+      continue
+    extremes = set()
+    for field in [1, 2]:
+      extremes.add(min(indices, key=lambda i: points[i][field]))
+      extremes.add(max(indices, key=lambda i: points[i][field]))
+    kept.extend(sorted(extremes))
+  return [points[i] for i in kept]
+
+def line_points(metric, line):
+  """Returns the (x, y, y2, error) points of a line as they're drawn."""
+  if 'frame-' in metric:
+    return downsample_points(frame_line_points(line), args.max_frame_points)
+  return line
+
+def graph_labels(metric):
+  """Returns the labels of the x, y and second y axis (None if unused)."""
+  if 'frame-' in metric:
+    if metric == 'frame-bytes':
+      return ('Frame', 'Frame Size (bytes / frame)', None)
+    return ('Frame', metric.replace('frame-', '').upper(), 'Frame Size (bytes / frame)')
+  if metric in ['encode-time-utilization', 'cpu-time-utilization']:
+    return ('Layer Target Bitrate (kbps)', 'Encode Time (fraction)' if metric == 'encode-time-utilization' else 'Encode CPU Time (fraction, all threads)', None)
+  if metric == 'encode-peak-rss-kb':
+    return ('Layer Target Bitrate (kbps)', 'Encoder Peak Memory (kB)', None)
+  if metric == 'encode-fps':
+    return ('Layer Target Bitrate (kbps)', 'Encode Speed (frames / second)', None)
+  return ('Layer Target Bitrate (kbps)', metric.upper(), 'Bitrate Utilization (actual / target)')
+
+def image_formats():
+  return [extension for extension in args.formats if extension in IMAGE_FORMATS]
+
+def render_graph((subdir, graph_name)):
+  # Graph data is looked up in the global dict, which worker processes inherit
+  # when forked, instead of being pickled and sent to them.
+  lines = graph_dict[(subdir, graph_name)]
+  metric = graph_name.split(':')[-1]
+  fig, ax = plt.subplots()
+  ax.set_title(graph_name)
+  frame_data = 'frame-' in metric
+  ax2 = None
+  ax2_bitrate_utilization = False
+  linestyle = 'o--'
+  ax2_linestyle = 'x-'
+
+  (xlabel, ylabel, y2label) = graph_labels(metric)
+  ax.set_xlabel(xlabel)
+  ax.set_ylabel(ylabel)
+  if y2label:
+    ax2 = ax.twinx()
+    ax2.set_ylabel(y2label)
+    ax2_bitrate_utilization = not frame_data
+  if frame_data:
+    linestyle = '-'
+    ax2_linestyle = '-'
+  if metric in ['encode-time-utilization', 'cpu-time-utilization']:
+    # Draw a reference line for realtime.
+    ax.axhline(1.0, color='k', alpha=0.2, linestyle='--')
+
+  for title in sorted(lines.keys()):
+    points = line_points(metric, lines[title])
+    x = []
+    y = []
+    y2 = []
+    errors = []
+    for bitrate_kbps, value, utilization, error in points:
+        x.append(bitrate_kbps)
+        y.append(value)
+        y2.append(utilization)
+        errors.append(error)
+    if any(error is not None for error in errors):
+      ax.errorbar(x, y, yerr=[error or 0 for error in errors], fmt=linestyle, linewidth=1, capsize=3, label=title)
+    else:
+      ax.plot(x, y, linestyle, linewidth=1, label=title)
+    if ax2:
+      ax2.plot(x, y2, ax2_linestyle, alpha=0.2)
+    ax.legend(loc='best', fancybox=True, framealpha=0.5)
+
+  if metric in ['encode-time-utilization', 'cpu-time-utilization']:
+    # Make sure the horizontal reference line at 1.0 can be seen.
+    (lower, upper) = ax.get_ylim()
+    if upper < 1.10:
+      ax.set_ylim(top=1.10)
+
+  if metric in ['encode-peak-rss-kb', 'encode-fps']:
+    ax.set_ylim(bottom=0)
+
+  # TODO(pbos): Read 'input-total-frames' from input and set as graph xlim.
+  if frame_data:
+    ax.set_xlim(left=0)
+
+  if ax2_bitrate_utilization:
+    # Set bitrate limit axes to +/- 20%.
+    ax2.set_ylim(bottom=0.80, top=1.20)
+
+  for extension in image_formats():
+    path = graph_path(extension, subdir, graph_name)
+    make_dirs(os.path.dirname(os.path.join(args.out_dir, path)))
+    plt.savefig(os.path.join(args.out_dir, path))
+  plt.close()
+  return (subdir, graph_name)
 
+def graph_path(extension, subdir, graph_name):
+  # Relative to --out-dir.
+  return os.path.join(extension, subdir, "%s.%s" % (graph_name.replace(":", "-"), extension))
+
+def graph_hash(subdir, graph_name, lines):
+  graph_info = [GRAPH_STYLE_VERSION, subdir, graph_name, lines]
+  if subdir:
+    # Frame graphs also depend on how much they're downsampled.
+    graph_info.append(args.max_frame_points)
+  return hashlib.sha1(json.dumps(graph_info, sort_keys=True)).hexdigest()
+
+def read_manifest():
+  """Returns the graph hash of every file rendered into --out-dir before."""
+  try:
+    with open(os.path.join(args.out_dir, MANIFEST_FILE)) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+def write_manifest(manifest):
+  manifest_file = os.path.join(args.out_dir, MANIFEST_FILE)
+  with open(manifest_file + '.tmp', 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  os.rename(manifest_file + '.tmp', manifest_file)
+
+def remove_stale_graphs(manifest, graph_paths):
+  """Removes previously-rendered graphs that no longer have any data.
+
+  Only files of formats that are being rendered are removed.
+  """
+  for path in sorted(manifest.keys()):
+    if path in graph_paths or path.split(os.sep)[0] not in args.formats:
+      continue
+    print "Removing stale graph %s" % path
+    try:
+      os.remove(os.path.join(args.out_dir, path))
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+    del manifest[path]
+    # Remove frame-data directories that are left empty.
+    try:
+      os.rmdir(os.path.dirname(os.path.join(args.out_dir, path)))
+    except OSError:
+      pass
+
+def report_number(value):
+  # JSON has no NaN or infinity.
+  if value is None or math.isnan(value) or math.isinf(value):
+    return None
+  return value
+
+def report_graph((subdir, graph_name)):
+  """Returns a graph of the HTML report as compressed, base64-encoded JSON.
+
+  Graphs hold the points that render_graph() draws, including downsampling,
+  so that the report only has to scale and connect them.
+  """
+  lines = graph_dict[(subdir, graph_name)]
+  metric = graph_name.split(':')[-1]
+  frame_data = 'frame-' in metric
+  (xlabel, ylabel, y2label) = graph_labels(metric)
+  graph = {
+    'title': graph_name,
+    'x-label': xlabel,
+    'y-label': ylabel,
+    'y2-label': y2label,
+    'frame-data': frame_data,
+    'x-min': 0 if frame_data else None,
+    'y-min': 0 if metric in ['encode-peak-rss-kb', 'encode-fps'] else None,
+    'y-reference': 1.0 if metric in ['encode-time-utilization', 'cpu-time-utilization'] else None,
+    'y2-range': [0.80, 1.20] if y2label and not frame_data else None,
+    'lines': [],
+  }
+  for title in sorted(lines.keys()):
+    points = line_points(metric, lines[title])
+    errors = [report_number(error) for (_, _, _, error) in points]
+    graph['lines'].append({
+      'title': title,
+      'x': [x for (x, _, _, _) in points],
+      'y': [report_number(y) for (_, y, _, _) in points],
+      'y2': [report_number(y2) for (_, _, y2, _) in points],
+      'errors': errors if any(error is not None for error in errors) else None,
+    })
+  return base64.b64encode(zlib.compress(json.dumps(graph, separators=(',', ':')), 9))
+
+def report_hash(graph_hashes):
+  with open(REPORT_TEMPLATE) as f:
+    template = f.read()
+  return hashlib.sha1(json.dumps([template, sorted(graph_hashes)])).hexdigest()
+
+def write_report(clip_names, graph_keys, graphs):
+  """Writes a single HTML report of all graphs into --out-dir.
+
+  The report has an index of graphs per clip and metric, and draws only the
+  graph being viewed, from |graphs| as returned by report_graph().
+  """
+  index = {}
+  report_graphs = []
+  for ((subdir, graph_name), graph) in zip(graph_keys, graphs):
+    # Graph names start with their input file and window, which may contain
+    # dashes too.
+    clip = max([f for f in clip_names if graph_name.startswith(f + '-')], key=len)
+    metric = graph_name.split(':')[-1]
+    index.setdefault(clip, {}).setdefault(metric, []).append(len(report_graphs))
+    report_graphs.append([graph_name[len(clip) + 1:].rsplit(':', 1)[0], graph])
+  with open(REPORT_TEMPLATE) as f:
+    template = f.read()
+  # Keep graph names from ending the script element.
+  report_data = json.dumps({'index': index, 'graphs': report_graphs}, sort_keys=True).replace('</', '<\\/')
+  report_file = os.path.join(args.out_dir, REPORT_FILE)
+  with open(report_file + '.tmp', 'w') as f:
+    f.write(template.replace('{{REPORT_DATA}}', report_data))
+  os.rename(report_file + '.tmp', report_file)
+
+def build_graph_dict(graph_data):
+  """Returns the lines of every graph, keyed on (subdir, graph name)."""
   graph_dict = {}
-  for input_files in split_data(graph_data, 'input-file'):
-    for layer_pattern in split_data(input_files, 'layer-pattern'):
-      for data in layer_pattern:
-        metrics = [
-          'vpx-ssim',
-          'ssim',
-          'ssim-y',
-          'ssim-u',
-          'ssim-v',
-          'avg-psnr',
-          'avg-psnr-y',
-          'avg-psnr-u',
-          'avg-psnr-v',
-          'glb-psnr',
-          'glb-psnr-y',
-          'glb-psnr-u',
-          'glb-psnr-v',
-          'encode-time-utilization',
-          'vmaf'
-        ]
-        for metric in metrics:
-          generate_graphs(graph_dict, layer_pattern, metric, normalize_bitrate_config_string(data['bitrate-config-kbps']))
+  for (graph_key, graph_lines) in index_results(graph_data).iteritems():
+    for metric in metrics:
+      generate_graphs(graph_dict, graph_key, graph_lines, metric)
 
   for point in graph_data:
     pattern_match = layer_regex_pattern.match(point['layer-pattern'])
     num_temporal_layers = int(pattern_match.group(2))
     temporal_divide = 2 ** (num_temporal_layers - 1 - point['temporal-layer'])
-    frame_metrics = [
-      'frame-ssim',
-      'frame-ssim-y',
-      'frame-ssim-u',
-      'frame-ssim-v',
-      'frame-psnr',
-      'frame-psnr-y',
-      'frame-psnr-u',
-      'frame-psnr-v',
-      'frame-qp',
-      'frame-bytes',
-      'frame-vmaf'
-    ]
+    bitrate_config_string = normalize_bitrate_config_string(point['bitrate-config-kbps'])
+    clip_name = results_file.clip_name(point)
     for target_metric in frame_metrics:
       if target_metric not in point:
         continue
@@ -122,90 +398,82 @@ def main():
       split_on_codecs = target_metric == 'frame-qp'
 
       if split_on_codecs:
-        graph_name = "%s-%s-%s-%dkbps-tl%d-%s:%s" % (point['input-file'], point['layer-pattern'], normalize_bitrate_config_string(point['bitrate-config-kbps']), point['bitrate-config-kbps'][-1], point['temporal-layer'], point['codec'], target_metric)
+        graph_name = "%s-%s-%s-%dkbps-tl%d-%s:%s" % (clip_name, point['layer-pattern'], bitrate_config_string, point['bitrate-config-kbps'][-1], point['temporal-layer'], point['codec'], target_metric)
         line_name = '%s' % point['encoder']
       else:
-        graph_name = "%s-%s-%s-%dkbps-tl%d:%s" % (point['input-file'], point['layer-pattern'], normalize_bitrate_config_string(point['bitrate-config-kbps']), point['bitrate-config-kbps'][-1], point['temporal-layer'], target_metric)
+        graph_name = "%s-%s-%s-%dkbps-tl%d:%s" % (clip_name, point['layer-pattern'], bitrate_config_string, point['bitrate-config-kbps'][-1], point['temporal-layer'], target_metric)
         line_name = '%s:%s' % (point['encoder'], point['codec'])
       graph_info = ('frame-data-%s/' % point['input-file'], graph_name)
       if not graph_info in graph_dict:
         graph_dict[graph_info] = {}
-      line = []
-      for idx, val in enumerate(point[target_metric]):
-        frame_size = point['frame-bytes'][idx] if 'frame-bytes' in point else -1
-        line.append((point['frame-offset'] + temporal_divide * idx + 1, val, frame_size))
-      graph_dict[graph_info][line_name] = line
-
-  current_graph = 1
-  total_graphs = len(graph_dict)
-  for (subdir, graph_name), lines in graph_dict.iteritems():
-    print "[%d/%d] %s" % (current_graph, total_graphs, graph_name)
-    current_graph += 1
-    metric = graph_name.split(':')[-1]
-    fig, ax = plt.subplots()
-    ax.set_title(graph_name)
-    frame_data = 'frame-' in metric
-    ax2 = None
-    ax2_bitrate_utilization = False
-    linestyle = 'o--'
-    ax2_linestyle = 'x-'
-
-    if frame_data:
-      ax.set_xlabel('Frame')
-      linestyle = '-'
-      if metric == 'frame-bytes':
-        ax.set_ylabel('Frame Size (bytes / frame)')
+      # Per-frame series are only decoded when the graph is rendered.
+      graph_dict[graph_info][line_name] = {
+        'first-frame': point['frame-offset'] + 1,
+        'frame-step': temporal_divide,
+        'values': point[target_metric],
+        'frame-bytes': point.get('frame-bytes'),
+        'frames': point.get('metric-frames') if target_metric not in ['frame-bytes', 'frame-qp'] else None,
+      }
+  return graph_dict
+
+def main():
+  global args
+  global graph_dict
+  args = parser.parse_args()
+  graph_data = []
+  for f in args.graph_files:
+    graph_data.extend(results_file.read_results(f))
+
+  graph_dict = build_graph_dict(graph_data)
+
+  # Only render graphs whose data (or style) changed since the last run.
+  manifest = read_manifest()
+  graph_paths = {}
+  graph_jobs = []
+  graph_hashes = []
+  for (subdir, graph_name) in sorted(graph_dict.keys()):
+    digest = graph_hash(subdir, graph_name, graph_dict[(subdir, graph_name)])
+    graph_hashes.append(digest)
+    paths = [graph_path(extension, subdir, graph_name) for extension in image_formats()]
+    for path in paths:
+      graph_paths[path] = digest
+    # Without image formats (only html) there's nothing to render.
+    if paths and (args.force or any(manifest.get(path) != digest or not os.path.exists(os.path.join(args.out_dir, path)) for path in paths)):
+      graph_jobs.append((subdir, graph_name))
+  remove_stale_graphs(manifest, graph_paths)
+  if image_formats():
+    print "%d of %d graphs are unchanged." % (len(graph_dict) - len(graph_jobs), len(graph_dict))
+
+  pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+  if pool:
+    rendered_graphs = pool.imap_unordered(render_graph, graph_jobs)
+  else:
+    rendered_graphs = (render_graph(graph_job) for graph_job in graph_jobs)
+
+  total_graphs = len(graph_jobs)
+  try:
+    for (current_graph, (subdir, graph_name)) in enumerate(rendered_graphs, 1):
+      print "[%d/%d] %s" % (current_graph, total_graphs, graph_name)
+      for extension in image_formats():
+        path = graph_path(extension, subdir, graph_name)
+        manifest[path] = graph_paths[path]
+
+    if 'html' in args.formats:
+      digest = report_hash(graph_hashes)
+      if args.force or manifest.get(REPORT_FILE) != digest or not os.path.exists(os.path.join(args.out_dir, REPORT_FILE)):
+        print "Writing %s with %d graphs." % (REPORT_FILE, len(graph_dict))
+        graph_keys = sorted(graph_dict.keys())
+        graphs = pool.imap(report_graph, graph_keys) if pool else (report_graph(graph_key) for graph_key in graph_keys)
+        write_report(set(results_file.clip_name(point) for point in graph_data), graph_keys, graphs)
+        manifest[REPORT_FILE] = digest
       else:
-        ax.set_ylabel(metric.replace('frame-', '').upper())
-        ax2 = ax.twinx()
-        ax2.set_ylabel('Frame Size (bytes / frame)')
-        ax2_linestyle = '-'
-    elif metric == 'encode-time-utilization':
-      ax.set_xlabel('Layer Target Bitrate (kbps)')
-      ax.set_ylabel('Encode Time (fraction)')
-      # Draw a reference line for realtime.
-      ax.axhline(1.0, color='k', alpha=0.2, linestyle='--')
-    else:
-      ax.set_xlabel('Layer Target Bitrate (kbps)')
-      ax.set_ylabel(metric.upper())
-      ax2 = ax.twinx()
-      ax2.set_ylabel('Bitrate Utilization (actual / target)')
-      ax2_bitrate_utilization = True
-
-    for title in sorted(lines.keys()):
-      points = lines[title]
-      x = []
-      y = []
-      y2 = []
-      for bitrate_kbps, value, utilization in points:
-          x.append(bitrate_kbps)
-          y.append(value)
-          y2.append(utilization)
-      ax.plot(x, y, linestyle, linewidth=1, label=title)
-      if ax2:
-        ax2.plot(x, y2, ax2_linestyle, alpha=0.2)
-      ax.legend(loc='best', fancybox=True, framealpha=0.5)
-
-    if metric == 'encode-time-utilization':
-      # Make sure the horizontal reference line at 1.0 can be seen.
-      (lower, upper) = ax.get_ylim()
-      if upper < 1.10:
-        ax.set_ylim(top=1.10)
-
-    # TODO(pbos): Read 'input-total-frames' from input and set as graph xlim.
-    if frame_data:
-      ax.set_xlim(left=0)
-
-    if ax2_bitrate_utilization:
-      # Set bitrate limit axes to +/- 20%.
-      ax2.set_ylim(bottom=0.80, top=1.20)
-
-    for extension in args.formats:
-      graph_dir =  os.path.join(args.out_dir, extension, subdir)
-      if not os.path.exists(graph_dir):
-        os.makedirs(graph_dir)
-      plt.savefig(os.path.join(graph_dir, "%s.%s" % (graph_name.replace(":", "-"), extension)))
-    plt.close()
+        print "%s is unchanged." % REPORT_FILE
+  finally:
+    # Keep graphs that were rendered before an interruption.
+    write_manifest(manifest)
+  if pool:
+    pool.close()
+    pool.join()
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python2
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import results_file
+
+# Bump whenever the contents of cached results change in a way that makes old
+# entries incompatible.
+CACHE_VERSION = 1
+# Eviction frees space down to this fraction of the maximum size, so that a
+# full cache isn't rescanned on every put.
+EVICTION_LOW_WATER_MARK = 0.9
+
+
+def key_for(key_info):
+  return hashlib.sha1(json.dumps(key_info, sort_keys=True)).hexdigest()
+
+
+class ResultCache(object):
+  """On-disk cache of job results, keyed on everything that affects them.
+
+  Entries are stored as one JSON file per key. When the cache grows above
+  |max_size_bytes| the least recently used entries are evicted until it's
+  below EVICTION_LOW_WATER_MARK of that.
+  """
+
+  def __init__(self, cache_dir, max_size_bytes=0):
+    self.cache_dir = cache_dir
+    self.max_size_bytes = max_size_bytes
+    self.lock = threading.Lock()
+    self.total_size = sum(size for (_, size, _) in self._entry_files())
+
+  def _entry_path(self, key):
+    return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+  def _entry_files(self):
+    for subdir in os.listdir(self.cache_dir):
+      subdir_path = os.path.join(self.cache_dir, subdir)
+      if len(subdir) != 2 or not os.path.isdir(subdir_path):
+        continue
+      for filename in os.listdir(subdir_path):
+        if not filename.endswith('.json'):
+          continue
+        path = os.path.join(subdir_path, filename)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        yield (path, stat.st_size, stat.st_mtime)
+
+  def get(self, key):
+    path = self._entry_path(key)
+    try:
+      with open(path) as f:
+        entry = json.load(f)
+      # Touch the entry so that eviction is least-recently-used.
+      os.utime(path, None)
+    except (IOError, OSError, ValueError):
+      return None
+    if entry.get('version') != CACHE_VERSION:
+      return None
+    return results_file.byteify(entry['results'])
+
+  def put(self, key, key_info, results):
+    path = self._entry_path(key)
+    if not os.path.isdir(os.path.dirname(path)):
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError:
+        # Racing with another worker creating the same directory.
+        pass
+    data = results_file.dumps({'version': CACHE_VERSION, 'key': key_info, 'results': results})
+    # Write to a temporary file first so that readers never see a partially
+    # written entry.
+    (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+      f.write(data)
+    old_size = os.path.getsize(path) if os.path.exists(path) else 0
+    os.rename(temp_path, path)
+    with self.lock:
+      self.total_size += len(data) - old_size
+      if self.max_size_bytes > 0 and self.total_size > self.max_size_bytes:
+        self._evict()
+
+  def _evict(self):
+    entries = sorted(self._entry_files(), key=lambda entry: entry[2])
+    self.total_size = sum(size for (_, size, _) in entries)
+    for (path, size, _) in entries:
+      if self.total_size <= self.max_size_bytes * EVICTION_LOW_WATER_MARK:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      self.total_size -= size
+
+  def entries(self):
+    for (path, size, mtime) in self._entry_files():
+      try:
+        with open(path) as f:
+          key_info = json.load(f).get('key', {})
+      except (IOError, ValueError):
+        key_info = {}
+      yield (os.path.splitext(os.path.basename(path))[0], size, mtime, key_info)
+
+  def purge(self, keys=None, older_than=None):
+    removed = 0
+    for (path, size, mtime) in list(self._entry_files()):
+      key = os.path.splitext(os.path.basename(path))[0]
+      if keys is not None and key not in keys:
+        continue
+      if older_than is not None and mtime >= older_than:
+        continue
+      os.remove(path)
+      removed += 1
+      with self.lock:
+        self.total_size -= size
+    return removed
+
+
+def describe(key_info):
+  job = key_info.get('job', {})
+  return "%s:%s %s %s frames %d+%s" % (job.get('encoder', '?'), job.get('codec', '?'), ":".join(str(i) for i in job.get('target_bitrates_kbps', [])), key_info.get('input-file', '?'), key_info.get('frame-offset', 0), key_info.get('num-frames', '?'))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Inspect or purge the generate_data.py result cache.')
+  parser.add_argument('--cache-dir', required=True)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.add_parser('list')
+  purge_parser = subparsers.add_parser('purge')
+  purge_parser.add_argument('keys', nargs='*', metavar='key')
+  purge_parser.add_argument('--older-than-days', type=float, default=None)
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.cache_dir):
+    sys.exit("ERROR: '%s' is not a directory." % args.cache_dir)
+  cache = ResultCache(args.cache_dir)
+
+  if args.command == 'list':
+    for (key, size, mtime, key_info) in sorted(cache.entries(), key=lambda entry: entry[2]):
+      print "%s %8d %s %s" % (key, size, time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime)), describe(key_info))
+    print "Total: %d bytes" % cache.total_size
+    return 0
+
+  older_than = None
+  if args.older_than_days is not None:
+    older_than = time.time() - args.older_than_days * 24 * 3600
+  removed = cache.purge(set(args.keys) if args.keys else None, older_than)
+  print "Removed %d cache entr%s." % (removed, "y" if removed == 1 else "ies")
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
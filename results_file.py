@@ -0,0 +1,134 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reading and writing of result files. Results are stored as one JSON object
+# per line, which can be appended to and read back incrementally. Files in the
+# older format (a Python list literal of result dicts) can still be read.
+#
+# Per-frame series (frame-* keys) are kept as array.array instances and stored
+# as base64-encoded little-endian arrays, instead of lists of numbers.
+
+import array
+import ast
+import base64
+import json
+import os
+import sys
+
+
+def byteify(value):
+  # json returns unicode strings, convert them back so that loaded results are
+  # indistinguishable from freshly generated ones.
+  if isinstance(value, dict):
+    return dict((byteify(k), byteify(v)) for (k, v) in value.iteritems())
+  if isinstance(value, list):
+    return [byteify(element) for element in value]
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+def encode_series(values):
+  """Encodes an array.array for JSON, use as json.dumps(default=...)."""
+  if not isinstance(values, array.array):
+    raise TypeError("%r is not JSON serializable" % (values,))
+  if sys.byteorder != 'little':
+    values = array.array(values.typecode, values)
+    values.byteswap()
+  return {'array': values.typecode, 'base64': base64.b64encode(values.tostring())}
+
+
+def decode_series(value):
+  """Returns a per-frame series as a sequence of numbers.
+
+  Accepts encoded series as well as plain lists, as stored by older versions.
+  """
+  if not isinstance(value, dict):
+    return value
+  values = array.array(value['array'], base64.b64decode(value['base64']))
+  if sys.byteorder != 'little':
+    values.byteswap()
+  return values
+
+
+def dumps(value):
+  return json.dumps(value, sort_keys=True, default=encode_series)
+
+
+def write_result(f, result):
+  """Appends |result| to |f| as a single line written at once.
+
+  Records are never interleaved or partially written by a well-behaved run, so
+  a file is readable up to its last complete line even if a run is killed.
+  """
+  f.flush()
+  data = dumps(result) + '\n'
+  while data:
+    written = os.write(f.fileno(), data)
+    data = data[written:]
+
+
+def read_results(f):
+  """Yields result dicts from a result file in either format.
+
+  Per-frame series are left encoded, see decode_series().
+  """
+  line = f.readline()
+  if line.lstrip().startswith('['):
+    for result in read_legacy_results(line + f.read()):
+      yield result
+    return
+
+  while line:
+    if line.strip():
+      try:
+        result = json.loads(line)
+      except ValueError:
+        if not line.endswith('\n'):
+          # Last record of an interrupted run.
+          return
+        raise
+      yield byteify(result)
+    line = f.readline()
+
+
+def read_legacy_results(data):
+  """Parses results written as a Python list literal by older versions."""
+  try:
+    return ast.literal_eval(data)
+  except SyntaxError:
+    # Interrupted runs never wrote the closing bracket.
+    return ast.literal_eval(data.rstrip().rstrip(',') + ']')
+
+
+def result_num_frames(result):
+  # Older results don't record their window's length, derive it from the
+  # realtime encode duration.
+  if 'num-frames' in result:
+    return result['num-frames']
+  return int(round(result['target-encode-time-ms'] * result['fps'] / 1000))
+
+
+def clip_name(result):
+  """Returns the input file of a result along with its frame window, if any.
+
+  Windows are written like in clip arguments to generate_data.py, so results
+  of different windows of a clip are kept apart. Results of whole clips are
+  named after their input file only.
+  """
+  frame_offset = result.get('frame-offset', 0)
+  num_frames = result_num_frames(result)
+  if frame_offset == 0 and num_frames >= result['input-total-frames']:
+    return result['input-file']
+  return '%s@%d+%d' % (result['input-file'], frame_offset, num_frames)
@@ -0,0 +1,97 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Minimal YUV4MPEG2 (.y4m) parsing, enough to read I420 frames without first
+# converting clips to raw .yuv files.
+
+import os
+
+MAGIC = 'YUV4MPEG2 '
+FRAME_MAGIC = 'FRAME'
+# Longest header line accepted, real headers are a few dozen bytes.
+MAX_HEADER_SIZE = 1024
+
+# Chroma formats that are stored as I420.
+I420_CHROMA_FORMATS = ['420', '420jpeg', '420paldv', '420mpeg2']
+
+
+class Y4mError(Exception):
+  pass
+
+
+def read_line(f, what):
+  line = f.readline(MAX_HEADER_SIZE)
+  if not line.endswith('\n'):
+    raise Y4mError("Unterminated %s header." % what)
+  return line
+
+
+def parse_header(f):
+  """Parses the stream header of an open .y4m file.
+
+  Returns a dict with 'width', 'height', 'fps_num', 'fps_den', 'chroma' and
+  'header_size' (the stream header length in bytes).
+  """
+  line = read_line(f, 'stream')
+  if not line.startswith(MAGIC):
+    raise Y4mError("Missing YUV4MPEG2 signature.")
+  info = {'chroma': '420', 'header_size': len(line)}
+  for param in line[len(MAGIC):].split():
+    (tag, value) = (param[0], param[1:])
+    if tag == 'W':
+      info['width'] = int(value)
+    elif tag == 'H':
+      info['height'] = int(value)
+    elif tag == 'F':
+      (num, den) = value.split(':')
+      info['fps_num'] = int(num)
+      info['fps_den'] = int(den)
+    elif tag == 'C':
+      info['chroma'] = value
+  for required in ['width', 'height', 'fps_num']:
+    if required not in info:
+      raise Y4mError("Stream header is missing '%s'." % required)
+  if info['fps_num'] <= 0 or info['fps_den'] <= 0:
+    raise Y4mError("Invalid frame rate %d:%d." % (info['fps_num'], info['fps_den']))
+  return info
+
+
+def frame_size(info):
+  uv_width = (info['width'] + 1) // 2
+  uv_height = (info['height'] + 1) // 2
+  return info['width'] * info['height'] + 2 * uv_width * uv_height
+
+
+def read_info(filename):
+  """Reads geometry, frame rate and frame layout of a .y4m file.
+
+  Only I420 clips where every frame header is a bare 'FRAME' line are
+  accepted, so that frame N is at a fixed offset and can be read directly.
+  Adds 'frame_header_size' and 'num_frames' to the parsed stream header.
+  """
+  with open(filename, 'rb') as f:
+    info = parse_header(f)
+    if info['chroma'] not in I420_CHROMA_FORMATS:
+      raise Y4mError("Unsupported chroma format '%s', only 4:2:0 is supported." % info['chroma'])
+    first_frame_header = read_line(f, 'frame')
+  if first_frame_header != FRAME_MAGIC + '\n':
+    raise Y4mError("Frame headers with parameters are not supported.")
+  info['frame_header_size'] = len(first_frame_header)
+  stride = info['frame_header_size'] + frame_size(info)
+  data_size = os.path.getsize(filename) - info['header_size']
+  if data_size % stride != 0:
+    raise Y4mError("File size doesn't match a whole number of frames.")
+  info['num_frames'] = data_size // stride
+  return info
+
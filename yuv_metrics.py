@@ -0,0 +1,237 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-process PSNR/SSIM computation for I420 files. This mirrors the
+# computations done by libvpx/tools/tiny_ssim so that results can be compared
+# directly between the two.
+
+import array
+import math
+import os
+
+import numpy
+
+# Bump when results computed here change.
+VERSION = 1
+
+MAX_PSNR = 100.0
+
+# SSIM constants used by libvpx for 8x8 windows: 64^2 * (.01*255)^2 and
+# 64^2 * (.03*255)^2, scaled by (64 * 64) >> 12.
+SSIM_C1 = (26634 * 64 * 64) >> 12
+SSIM_C2 = (239708 * 64 * 64) >> 12
+
+# Number of frames processed in one vectorized batch.
+BATCH_FRAMES = 8
+
+
+def plane_sizes(width, height):
+  uv_width = (width + 1) // 2
+  uv_height = (height + 1) // 2
+  return [(width, height), (uv_width, uv_height), (uv_width, uv_height)]
+
+
+def frame_size(width, height):
+  return sum(w * h for (w, h) in plane_sizes(width, height))
+
+
+def mse2psnr(samples, sse):
+  # Works on scalars as well as arrays of squared errors.
+  sse = numpy.asarray(sse, dtype=numpy.float64)
+  with numpy.errstate(divide='ignore'):
+    psnr = 10.0 * numpy.log10(255.0 * 255.0 * samples / sse)
+  return numpy.where(sse > 0, numpy.minimum(psnr, MAX_PSNR), MAX_PSNR)
+
+
+def _block_sums(plane, block):
+  # Sums over non-overlapping |block|x|block| blocks of a single plane. Sums
+  # are accumulated as int64 but only stored per block.
+  (h, w) = plane.shape
+  h -= h % block
+  w -= w % block
+  return plane[:h, :w].reshape(h // block, block, w // block, block).sum(axis=(1, 3), dtype=numpy.int64)
+
+
+def _window_sums(plane):
+  # Sums over 8x8 windows sampled every 4 pixels, built from 4x4 block sums.
+  blocks = _block_sums(plane, 4)
+  return blocks[:-1, :-1] + blocks[1:, :-1] + blocks[:-1, 1:] + blocks[1:, 1:]
+
+
+def _square_products(a, b):
+  # Products of 8-bit samples fit in 16 bits, this keeps full-resolution
+  # temporaries at two bytes per sample.
+  return numpy.multiply(a, b, dtype=numpy.uint16)
+
+
+def plane_ssim(reference, distorted):
+  """Mean SSIM over 8x8 windows for a batch of planes of shape (n, h, w).
+
+  Planes are compared one at a time so that temporaries stay proportional to
+  a single plane rather than to the whole batch.
+  """
+  ssim = numpy.zeros(len(reference))
+  count = 64
+  for i in range(len(reference)):
+    (s, r) = (reference[i], distorted[i])
+    sum_s = _window_sums(s)
+    sum_r = _window_sums(r)
+    sum_sq_s = _window_sums(_square_products(s, s))
+    sum_sq_r = _window_sums(_square_products(r, r))
+    sum_sxr = _window_sums(_square_products(s, r))
+    ssim_n = (2 * sum_s * sum_r + SSIM_C1) * (2 * count * sum_sxr - 2 * sum_s * sum_r + SSIM_C2)
+    ssim_d = (sum_s * sum_s + sum_r * sum_r + SSIM_C1) * (count * sum_sq_s - sum_s * sum_s + count * sum_sq_r - sum_r * sum_r + SSIM_C2)
+    ssim[i] = (ssim_n.astype(numpy.float64) / ssim_d).mean()
+  return ssim
+
+
+def plane_sse(reference, distorted):
+  """Sum of squared errors for a batch of planes of shape (n, h, w)."""
+  sse = numpy.zeros(len(reference), dtype=numpy.int64)
+  for i in range(len(reference)):
+    (s, r) = (reference[i], distorted[i])
+    diff = numpy.maximum(s, r) - numpy.minimum(s, r)
+    sse[i] = _square_products(diff, diff).sum(dtype=numpy.int64)
+  return sse
+
+
+def split_planes(frames, width, height):
+  planes = []
+  offset = 0
+  for (w, h) in plane_sizes(width, height):
+    planes.append(frames[:, offset:offset + w * h].reshape(-1, h, w))
+    offset += w * h
+  return planes
+
+
+def map_frames(filename, width, height, frame_offset=0, num_frames=None, header_size=0, frame_header_size=0):
+  """Memory-maps a window of frames in an I420 file without reading it.
+
+  |header_size| and |frame_header_size| skip over file and per-frame headers,
+  such as the ones in .y4m files.
+  """
+  size = frame_size(width, height)
+  stride = frame_header_size + size
+  available_frames = max((os.path.getsize(filename) - header_size) // stride - frame_offset, 0)
+  if num_frames is None or num_frames > available_frames:
+    num_frames = available_frames
+  if num_frames == 0:
+    return numpy.zeros((0, size), dtype=numpy.uint8)
+  frames = numpy.memmap(filename, dtype=numpy.uint8, mode='r', offset=header_size + frame_offset * stride, shape=(num_frames, stride))
+  return frames[:, frame_header_size:]
+
+
+def frame_metrics(reference_frames, distorted_frames, width, height):
+  """Per-frame metrics for two equally-sized batches of frames.
+
+  Returns a dict of arrays with SSIM and PSNR values for each frame, along
+  with the per-plane squared errors used for global PSNR.
+  """
+  reference_planes = split_planes(reference_frames, width, height)
+  distorted_planes = split_planes(distorted_frames, width, height)
+  ssim = [plane_ssim(reference_planes[i], distorted_planes[i]) for i in range(3)]
+  sse = [plane_sse(reference_planes[i], distorted_planes[i]) for i in range(3)]
+  samples = [w * h for (w, h) in plane_sizes(width, height)]
+  return {
+    'ssim': 0.8 * ssim[0] + 0.1 * (ssim[1] + ssim[2]),
+    'ssim-y': ssim[0],
+    'ssim-u': ssim[1],
+    'ssim-v': ssim[2],
+    'psnr': mse2psnr(sum(samples), sse[0] + sse[1] + sse[2]),
+    'psnr-y': mse2psnr(samples[0], sse[0]),
+    'psnr-u': mse2psnr(samples[1], sse[1]),
+    'psnr-v': mse2psnr(samples[2], sse[2]),
+    'sse-y': sse[0],
+    'sse-u': sse[1],
+    'sse-v': sse[2],
+  }
+
+
+FRAME_METRICS = ['ssim', 'ssim-y', 'ssim-u', 'ssim-v', 'psnr', 'psnr-y', 'psnr-u', 'psnr-v']
+
+
+def aggregate_metrics(frames, width, height):
+  """Aggregates per-frame metrics into the values tiny_ssim reports.
+
+  Keys match the ones used for results in generate_data.py.
+  """
+  num_frames = len(frames['ssim'])
+  samples = [w * h for (w, h) in plane_sizes(width, height)]
+  sse = [frames['sse-y'].sum(), frames['sse-u'].sum(), frames['sse-v'].sum()]
+  ssim = frames['ssim'].mean()
+  results = {
+    'avg-psnr': frames['psnr'].mean(),
+    'avg-psnr-y': frames['psnr-y'].mean(),
+    'avg-psnr-u': frames['psnr-u'].mean(),
+    'avg-psnr-v': frames['psnr-v'].mean(),
+    'glb-psnr': mse2psnr(num_frames * sum(samples), sum(sse)),
+    'glb-psnr-y': mse2psnr(num_frames * samples[0], sse[0]),
+    'glb-psnr-u': mse2psnr(num_frames * samples[1], sse[1]),
+    'glb-psnr-v': mse2psnr(num_frames * samples[2], sse[2]),
+    'ssim': ssim,
+    'ssim-y': frames['ssim-y'].mean(),
+    'ssim-u': frames['ssim-u'].mean(),
+    'ssim-v': frames['ssim-v'].mean(),
+    'vpx-ssim': 100 * math.pow(ssim, 8.0),
+  }
+  results = dict((metric, float(value)) for (metric, value) in results.iteritems())
+  results['frame-count'] = num_frames
+  for metric in FRAME_METRICS:
+    results['frame-%s' % metric] = array.array('d', frames[metric].astype(numpy.float64).tostring())
+  return results
+
+
+def frames_from_buffer(data, width, height):
+  """Wraps whole frames of a string of I420 data, ignoring trailing bytes."""
+  size = frame_size(width, height)
+  num_frames = len(data) // size
+  if num_frames == 0:
+    return numpy.zeros((0, size), dtype=numpy.uint8)
+  return numpy.frombuffer(data, dtype=numpy.uint8, count=num_frames * size).reshape(num_frames, size)
+
+
+class FrameComparator(object):
+  """Accumulates per-frame metrics for frames compared incrementally."""
+
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+    self.batches = []
+
+  def add_frames(self, reference_frames, distorted_frames):
+    self.batches.append(frame_metrics(reference_frames, distorted_frames, self.width, self.height))
+
+  def results(self):
+    """Returns aggregated results or None if no frames have been compared."""
+    if not self.batches:
+      return None
+    frames = dict((metric, numpy.concatenate([batch[metric] for batch in self.batches])) for metric in self.batches[0])
+    return aggregate_metrics(frames, self.width, self.height)
+
+
+def compare_files(reference, distorted_file, width, height):
+  """Computes PSNR and SSIM between reference frames and a distorted I420 file.
+
+  |reference| holds the frames to compare against (see map_frames()), one for
+  each frame in the distorted file. Returns results keyed the same way as
+  tiny_ssim output is in generate_data.py, or None if there are no frames to
+  compare.
+  """
+  distorted = map_frames(distorted_file, width, height)
+  num_frames = min(len(reference), len(distorted))
+  comparator = FrameComparator(width, height)
+  for start in range(0, num_frames, BATCH_FRAMES):
+    end = min(start + BATCH_FRAMES, num_frames)
+    comparator.add_frames(reference[start:end], distorted[start:end])
+  return comparator.results()
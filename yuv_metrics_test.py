@@ -0,0 +1,239 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Conformance tests of yuv_metrics against a scalar port of
+# libvpx/tools/tiny_ssim.c. Run with:
+#
+#   python -m unittest yuv_metrics_test
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import yuv_metrics
+
+
+def tiny_ssim_similarity(sum_s, sum_r, sum_sq_s, sum_sq_r, sum_sxr, count):
+  c1 = (26634 * count * count) >> 12
+  c2 = (239708 * count * count) >> 12
+  ssim_n = (2 * sum_s * sum_r + c1) * (2 * count * sum_sxr - 2 * sum_s * sum_r + c2)
+  ssim_d = (sum_s * sum_s + sum_r * sum_r + c1) * (count * sum_sq_s - sum_s * sum_s + count * sum_sq_r - sum_r * sum_r + c2)
+  return ssim_n * 1.0 / ssim_d
+
+
+def tiny_ssim_plane(img1, img2, width, height):
+  """Port of ssim2(): 8x8 windows at every 4x4 location, one at a time."""
+  total = 0.0
+  samples = 0
+  for i in range(0, height - 8 + 1, 4):
+    for j in range(0, width - 8 + 1, 4):
+      (sum_s, sum_r, sum_sq_s, sum_sq_r, sum_sxr) = (0, 0, 0, 0, 0)
+      for y in range(i, i + 8):
+        for x in range(j, j + 8):
+          s = int(img1[y * width + x])
+          r = int(img2[y * width + x])
+          sum_s += s
+          sum_r += r
+          sum_sq_s += s * s
+          sum_sq_r += r * r
+          sum_sxr += s * r
+      total += tiny_ssim_similarity(sum_s, sum_r, sum_sq_s, sum_sq_r, sum_sxr, 64)
+      samples += 1
+  return total / samples
+
+
+def tiny_ssim_mse2psnr(samples, sse):
+  psnr = 10.0 * math.log10(255.0 * 255.0 * samples / sse) if sse > 0 else yuv_metrics.MAX_PSNR
+  return min(psnr, yuv_metrics.MAX_PSNR)
+
+
+def tiny_ssim(reference_file, distorted_file, width, height, temporal_skip=0):
+  """Port of tiny_ssim's main loop, returning results keyed like yuv_metrics.
+
+  Every distorted frame is compared to the next reference frame, after which
+  |temporal_skip| reference frames are skipped. Comparison stops when either
+  file runs out of frames.
+  """
+  # Chroma planes are rounded up, as in tiny_ssim.
+  (uv_width, uv_height) = ((width + 1) // 2, (height + 1) // 2)
+  planes = [(width, height), (uv_width, uv_height), (uv_width, uv_height)]
+  size = width * height + 2 * uv_width * uv_height
+  frames = dict((metric, []) for metric in yuv_metrics.FRAME_METRICS)
+  total_sse = [0, 0, 0]
+  with open(reference_file, 'rb') as reference, open(distorted_file, 'rb') as distorted:
+    while True:
+      frame1 = reference.read(size)
+      frame2 = distorted.read(size)
+      if len(frame1) < size or len(frame2) < size:
+        break
+      reference.seek(size * temporal_skip, os.SEEK_CUR)
+      frame1 = bytearray(frame1)
+      frame2 = bytearray(frame2)
+      (ssim, sse) = ([], [])
+      offset = 0
+      for (w, h) in planes:
+        plane1 = frame1[offset:offset + w * h]
+        plane2 = frame2[offset:offset + w * h]
+        ssim.append(tiny_ssim_plane(plane1, plane2, w, h))
+        sse.append(sum((a - b) * (a - b) for (a, b) in zip(plane1, plane2)))
+        offset += w * h
+      for plane in range(3):
+        total_sse[plane] += sse[plane]
+      frames['ssim'].append(ssim[0] * 0.8 + 0.1 * (ssim[1] + ssim[2]))
+      frames['ssim-y'].append(ssim[0])
+      frames['ssim-u'].append(ssim[1])
+      frames['ssim-v'].append(ssim[2])
+      frames['psnr'].append(tiny_ssim_mse2psnr(size, sum(sse)))
+      for (plane, name) in enumerate(['y', 'u', 'v']):
+        frames['psnr-%s' % name].append(tiny_ssim_mse2psnr(planes[plane][0] * planes[plane][1], sse[plane]))
+  num_frames = len(frames['ssim'])
+  results = {}
+  for metric in ['ssim', 'ssim-y', 'ssim-u', 'ssim-v']:
+    results[metric] = sum(frames[metric]) / num_frames
+  for metric in ['psnr', 'psnr-y', 'psnr-u', 'psnr-v']:
+    results['avg-%s' % metric] = sum(frames[metric]) / num_frames
+  results['glb-psnr'] = tiny_ssim_mse2psnr(num_frames * size, sum(total_sse))
+  for (plane, name) in enumerate(['y', 'u', 'v']):
+    results['glb-psnr-%s' % name] = tiny_ssim_mse2psnr(num_frames * planes[plane][0] * planes[plane][1], total_sse[plane])
+  results['vpx-ssim'] = 100 * math.pow(results['ssim'], 8.0)
+  results['frame-count'] = num_frames
+  for metric in yuv_metrics.FRAME_METRICS:
+    results['frame-%s' % metric] = frames[metric]
+  return results
+
+
+class YuvMetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.random = numpy.random.RandomState(4711)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def write_clip(self, name, frames):
+    path = os.path.join(self.temp_dir, name)
+    with open(path, 'wb') as f:
+      f.write(frames.astype(numpy.uint8).tostring())
+    return path
+
+  def synthetic_clips(self, width, height, num_frames, noise):
+    """Writes a smooth reference clip and a noisy copy, returns their paths."""
+    size = yuv_metrics.frame_size(width, height)
+    ramp = numpy.arange(size) % 251
+    reference = (ramp + numpy.arange(num_frames)[:, numpy.newaxis] * 7) % 256
+    distorted = numpy.clip(reference + self.random.randint(-noise, noise + 1, reference.shape), 0, 255)
+    return (self.write_clip('reference.yuv', reference), self.write_clip('distorted.yuv', distorted))
+
+  def assert_matches_tiny_ssim(self, results, expected):
+    self.assertEqual(results['frame-count'], expected['frame-count'])
+    for metric in expected:
+      if metric.startswith('frame-'):
+        if metric != 'frame-count':
+          self.assertEqual(len(results[metric]), len(expected[metric]), metric)
+          for (value, expected_value) in zip(results[metric], expected[metric]):
+            self.assertAlmostEqual(value, expected_value, places=9, msg=metric)
+      else:
+        self.assertAlmostEqual(results[metric], expected[metric], places=9, msg=metric)
+
+  def compare(self, reference_file, distorted_file, width, height, temporal_skip=0):
+    # Reference frames are selected the same way as in generate_data.py.
+    reference = yuv_metrics.map_frames(reference_file, width, height)[::temporal_skip + 1]
+    return yuv_metrics.compare_files(reference, distorted_file, width, height)
+
+  def test_plane_ssim(self):
+    for (width, height) in [(8, 8), (16, 16), (19, 13), (35, 21)]:
+      reference = self.random.randint(0, 256, (1, height, width)).astype(numpy.uint8)
+      distorted = numpy.clip(reference + self.random.randint(-20, 21, reference.shape), 0, 255).astype(numpy.uint8)
+      expected = tiny_ssim_plane(bytearray(reference.astype(numpy.uint8).tostring()), bytearray(distorted.astype(numpy.uint8).tostring()), width, height)
+      self.assertAlmostEqual(yuv_metrics.plane_ssim(reference, distorted)[0], expected, places=12)
+
+  def test_fixed_values(self):
+    # Flat luma planes of 100 and 110 with identical chroma. Expected values are
+    # worked out from tiny_ssim.c's similarity() by hand rather than through
+    # the port above, so both implementations are pinned to the same numbers:
+    # every 8x8 luma window gives 45069317 / 45274117 and chroma windows give 1.
+    (width, height) = (16, 16)
+    reference = numpy.full((2, yuv_metrics.frame_size(width, height)), 128)
+    reference[:, :width * height] = 100
+    distorted = reference.copy()
+    distorted[:, :width * height] = 110
+    results = self.compare(self.write_clip('reference.yuv', reference), self.write_clip('distorted.yuv', distorted), width, height)
+    self.assertEqual(results['frame-count'], 2)
+    self.assertAlmostEqual(results['ssim-y'], 0.9954764440795167, places=12)
+    self.assertAlmostEqual(results['ssim-u'], 1.0, places=12)
+    self.assertAlmostEqual(results['ssim'], 0.9963811552636135, places=12)
+    self.assertAlmostEqual(results['vpx-ssim'], 97.1413289140556, places=9)
+    self.assertAlmostEqual(results['glb-psnr-y'], 28.130803608679106, places=12)
+    self.assertAlmostEqual(results['glb-psnr'], 29.89171619923592, places=12)
+    self.assertEqual(results['glb-psnr-u'], yuv_metrics.MAX_PSNR)
+
+  def test_compare_files(self):
+    (reference_file, distorted_file) = self.synthetic_clips(32, 24, 3, 10)
+    self.assert_matches_tiny_ssim(self.compare(reference_file, distorted_file, 32, 24), tiny_ssim(reference_file, distorted_file, 32, 24))
+
+  def test_odd_size(self):
+    # Chroma planes are rounded up and partial windows at the edges ignored.
+    (reference_file, distorted_file) = self.synthetic_clips(35, 21, 3, 30)
+    self.assert_matches_tiny_ssim(self.compare(reference_file, distorted_file, 35, 21), tiny_ssim(reference_file, distorted_file, 35, 21))
+
+  def test_temporal_skip(self):
+    (width, height) = (17, 17)
+    (reference_file, noisy_file) = self.synthetic_clips(width, height, 7, 5)
+    # A lower temporal layer holds every other (or every fourth) frame.
+    for temporal_skip in [1, 3]:
+      noisy = yuv_metrics.map_frames(noisy_file, width, height)
+      layer_file = self.write_clip('layer.yuv', numpy.array(noisy[::temporal_skip + 1]))
+      self.assert_matches_tiny_ssim(self.compare(reference_file, layer_file, width, height, temporal_skip), tiny_ssim(reference_file, layer_file, width, height, temporal_skip))
+
+  def test_shorter_reference(self):
+    (reference_file, distorted_file) = self.synthetic_clips(16, 16, 4, 5)
+    reference = yuv_metrics.map_frames(reference_file, 16, 16, num_frames=2)
+    results = yuv_metrics.compare_files(reference, distorted_file, 16, 16)
+    self.assertEqual(results['frame-count'], 2)
+
+  def test_identical(self):
+    (reference_file, _) = self.synthetic_clips(16, 16, 2, 0)
+    results = self.compare(reference_file, reference_file, 16, 16)
+    self.assert_matches_tiny_ssim(results, tiny_ssim(reference_file, reference_file, 16, 16))
+    self.assertEqual(results['glb-psnr'], yuv_metrics.MAX_PSNR)
+    self.assertAlmostEqual(results['ssim'], 1.0)
+
+  def test_batches(self):
+    # More frames than fit in one batch.
+    num_frames = yuv_metrics.BATCH_FRAMES * 2 + 3
+    (reference_file, distorted_file) = self.synthetic_clips(16, 16, num_frames, 15)
+    self.assert_matches_tiny_ssim(self.compare(reference_file, distorted_file, 16, 16), tiny_ssim(reference_file, distorted_file, 16, 16))
+
+  def test_map_frames_window(self):
+    # Windows skip file and frame headers, as for .y4m clips.
+    (width, height) = (16, 16)
+    size = yuv_metrics.frame_size(width, height)
+    frames = self.random.randint(0, 256, (5, size))
+    path = os.path.join(self.temp_dir, 'headers.yuv')
+    with open(path, 'wb') as f:
+      f.write('HEADER\n')
+      for frame in frames:
+        f.write('FRAME\n')
+        f.write(frame.astype(numpy.uint8).tostring())
+    window = yuv_metrics.map_frames(path, width, height, frame_offset=1, num_frames=3, header_size=7, frame_header_size=6)
+    self.assertTrue(numpy.array_equal(window, frames[1:4]))
+
+
+if __name__ == '__main__':
+  unittest.main()